@@ -1,94 +1,154 @@
 import os
-import datetime
-import base64
-import requests
-import asyncio
+import re
+import sys
 import json
-from fastapi import FastAPI, HTTPException, Response
+import asyncio
+from fastapi import FastAPI, HTTPException, Header, Query, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 from mangum import Mangum
 
+# Add project root to path to allow imports from other files
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lastfm
+import images
+import metrics
+import nowplaying
+from cache import CACHE_URL, SWRCache, make_backend, make_etag, etag_matches
+
 # --- .ENV LOADING ---
 load_dotenv()
 
 # --- LAST.FM SETUP ---
 LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
 LASTFM_USERNAME = os.getenv("LASTFM_USERNAME")
-LASTFM_API_BASE_URL = "https://ws.audioscrobbler.com/2.0/"
-
-# --- LAST.FM HELPER FUNCTION ---
-def get_lastfm_recent_tracks():
-    params = {
-        "method": "user.getrecenttracks",
-        "user": LASTFM_USERNAME,
-        "api_key": LASTFM_API_KEY,
-        "format": "json",
-        "limit": 1
-    }
-    response = requests.get(LASTFM_API_BASE_URL, params=params, timeout=30)
-    response.raise_for_status()
-    return response.json()
-
-# --- PYDANTIC SCHEMA ---
-class NowPlayingResponse(BaseModel):
-    track: str
-    artist: str
-    album_cover: str | None
-    track_link: str | None
-    currently_playing: bool
+# Optional secret for /api/metrics, sent as the x-metrics-secret header
+METRICS_SECRET = os.getenv("METRICS_SECRET")
+
+# Responses are fresh for LASTFM_CACHE_TTL seconds, then served stale for up
+# to LASTFM_STALE_TTL more while a single background request refreshes them.
+LASTFM_CACHE_TTL = float(os.getenv("LASTFM_CACHE_TTL", "15"))
+LASTFM_STALE_TTL = float(os.getenv("LASTFM_STALE_TTL", "60"))
+CACHE_CONTROL = f"s-maxage={int(LASTFM_CACHE_TTL)}, stale-while-revalidate"
+# Users kept in the cache at once; the least recently requested are evicted first.
+LASTFM_CACHE_MAX_USERS = int(os.getenv("LASTFM_CACHE_MAX_USERS", "1000"))
+# Maximum number of users in one /api/now-playing?users=... request
+LASTFM_MAX_BATCH = int(os.getenv("LASTFM_MAX_BATCH", "50"))
+
+USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+# Serialized response bodies by lower-cased Last.fm username, in the CACHE_URL
+# backend, so a user fetched by one instance is served by all of them. The
+# version in the namespace changes whenever the body format does.
+now_playing_cache = SWRCache(
+    ttl=LASTFM_CACHE_TTL, stale_ttl=LASTFM_STALE_TTL,
+    backend=make_backend(CACHE_URL, namespace="now-playing:v2:lastfm:", maxsize=LASTFM_CACHE_MAX_USERS),
+)
+metrics.register_cache("lastfm_now_playing", now_playing_cache)
+
+async def load_now_playing(username: str):
+    data = await lastfm.get_recent_tracks(username)
+    return nowplaying.from_lastfm(data).model_dump_json().encode()
+
+async def get_now_playing(username: str, max_age: float | None = None):
+    """Returns the cached `(body, etag)` for a user, fetching it from Last.fm when needed."""
+    body = await now_playing_cache.get(username.lower(), lambda: load_now_playing(username), max_age=max_age)
+    return body, make_etag(body)
+
+def conditional_response(body: bytes, etag: str, if_none_match: str | None):
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def check_configured():
+    if not LASTFM_API_KEY:
+        raise HTTPException(
+            status_code=500,
+            detail="Sunucu yapılandırılmamış. Lütfen Last.fm değişkenlerini kontrol edin."
+        )
+
+def check_username(username: str):
+    if not USERNAME_PATTERN.match(username):
+        raise HTTPException(status_code=400, detail=f"Geçersiz kullanıcı adı: {username}")
 
 # --- FASTAPI APP ---
 app = FastAPI()
 origins = ["*"]
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.include_router(images.router)
 
-@app.get("/api/now-playing", response_model=NowPlayingResponse)
-async def now_playing():
-    if not all([LASTFM_API_KEY, LASTFM_USERNAME]):
+@app.get("/api/now-playing")
+async def now_playing(
+    users: str | None = None,
+    max_age: float | None = Query(None, ge=0),
+    if_none_match: str | None = Header(None),
+):
+    """
+    Without `users`, returns the now-playing state of LASTFM_USERNAME.
+    With `users=a,b,c`, fetches every listed user concurrently and returns
+    `{"users": {name: state}, "errors": {name: message}}`.
+    `max_age` asks for data at most that many seconds old.
+    """
+    check_configured()
+    if users is not None:
+        return await now_playing_batch(users, max_age, if_none_match)
+    if not LASTFM_USERNAME:
         raise HTTPException(
             status_code=500,
             detail="Sunucu yapılandırılmamış. Lütfen Last.fm değişkenlerini kontrol edin."
         )
+    return await now_playing_for_user(LASTFM_USERNAME, max_age, if_none_match)
 
-    try:
-        data = get_lastfm_recent_tracks()
-        recent_tracks = data.get("recenttracks", {}).get("track", [])
-
-        if not recent_tracks:
-            response_data = NowPlayingResponse(
-                track="Bilinmiyor", artist="Bilinmiyor", album_cover=None,
-                track_link=None, currently_playing=False
-            )
-        else:
-            latest_track = recent_tracks[0]
-            is_playing = latest_track.get("@attr", {}).get("nowplaying") == "true"
-
-            if is_playing:
-                response_data = NowPlayingResponse(
-                    track=latest_track.get("name"),
-                    artist=latest_track.get("artist", {}).get("#text"),
-                    album_cover=latest_track.get("image", [{}, {}, {}, {"#text": None}])[3].get("#text"),
-                    track_link=latest_track.get("url"),
-                    currently_playing=True,
-                )
-            else:
-                response_data = NowPlayingResponse(
-                    track="En son dinlenen", artist="Şu anda bir şey çalmıyor", album_cover=None,
-                    track_link=None, currently_playing=False
-                )
-
-        json_content = response_data.model_dump_json()
-        return Response(
-            content=json_content,
-            media_type="application/json",
-            headers={"Cache-Control": "s-maxage=15, stale-while-revalidate"}
-        )
+@app.get("/api/now-playing/{username}", response_model=nowplaying.NowPlayingResponse)
+async def now_playing_user(
+    username: str,
+    max_age: float | None = Query(None, ge=0),
+    if_none_match: str | None = Header(None),
+):
+    check_configured()
+    check_username(username)
+    return await now_playing_for_user(username, max_age, if_none_match)
 
+async def now_playing_for_user(username: str, max_age: float | None, if_none_match: str | None):
+    try:
+        body, etag = await get_now_playing(username, max_age)
     except Exception as e:
+        metrics.record_error("lastfm", e)
         raise HTTPException(status_code=500, detail=f"Last.fm verisi alınırken hata: {str(e)}")
+    return conditional_response(body, etag, if_none_match)
+
+async def now_playing_batch(users: str, max_age: float | None, if_none_match: str | None):
+    usernames = list(dict.fromkeys(name.strip() for name in users.split(",") if name.strip()))
+    if not usernames:
+        raise HTTPException(status_code=400, detail="En az bir kullanıcı adı gerekli.")
+    if len(usernames) > LASTFM_MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"En fazla {LASTFM_MAX_BATCH} kullanıcı istenebilir.")
+    for username in usernames:
+        check_username(username)
+
+    results = await asyncio.gather(
+        *(get_now_playing(username, max_age) for username in usernames), return_exceptions=True
+    )
+
+    # Splice the cached bodies together instead of re-serializing them.
+    states, errors = [], {}
+    for username, result in zip(usernames, results):
+        if isinstance(result, Exception):
+            metrics.record_error("lastfm", result)
+            errors[username] = f"Last.fm verisi alınırken hata: {str(result)}"
+        else:
+            states.append(json.dumps(username).encode() + b":" + result[0])
+    body = b'{"users":{' + b",".join(states) + b'},"errors":' + json.dumps(errors).encode() + b"}"
+    return conditional_response(body, make_etag(body), if_none_match)
+
+@app.get("/api/metrics")
+async def get_metrics(x_metrics_secret: str | None = Header(None)):
+    if METRICS_SECRET and x_metrics_secret != METRICS_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized.")
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
 
 # This must be mounted after all API routes
 app.mount("/", StaticFiles(directory="public", html=True), name="public")
@@ -0,0 +1,68 @@
+"""Small asyncio building blocks shared by the HTTP clients and caches."""
+import asyncio
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers that arrive while a call
+    for their key is running wait for it and share its result or error.
+    Calls belong to the event loop they started on; a caller on another loop
+    (e.g. the next `asyncio.run` in a benchmark) starts its own.
+    """
+
+    def __init__(self):
+        self._inflight: dict = {}
+
+    def running(self, key):
+        """The in-flight call for `key` on the current event loop, if any."""
+        inflight = self._inflight.get(key)
+        if inflight is None or inflight.get_loop() is not asyncio.get_running_loop():
+            return None
+        return inflight
+
+    async def do(self, key, func):
+        """Returns `await func()`, or the result of the call already running for `key`."""
+        inflight = self.running(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting for it.
+            future.exception()
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+class LoopLocal:
+    """
+    Holds one object per event loop, made by `factory()` on first use. For
+    clients such as `httpx.AsyncClient`, whose connection pool is bound to
+    the event loop it was first used on.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        if self._value is None or self._loop is not loop:
+            self._value = self._factory()
+            self._loop = loop
+        return self._value
+
+    def pop(self):
+        """Forgets the current object and returns it (None if there is none), e.g. to close it."""
+        value, self._value, self._loop = self._value, None, None
+        return value
@@ -0,0 +1,137 @@
+"""
+Cold-start benchmark for the serverless entry points (main.py and api/index.py).
+
+Every run starts a fresh Python process that imports the app, runs its
+startup hooks and serves one request, with Spotify/Last.fm replaced by the
+local stand-ins from bench/fakes.py. Prints the results as JSON:
+
+    python bench/coldstart.py --runs 10
+    python bench/coldstart.py --auto-create-schema   # include schema creation at startup
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.dirname(os.path.abspath(__file__))
+
+# (module, first request path) per entry point
+TARGETS = {
+    "main": ("main", "/users/bench1/now-playing"),
+    "index": ("index", "/api/now-playing/bench1"),
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="cold starts per entry point")
+    parser.add_argument("--targets", default=",".join(TARGETS), help="comma-separated entry points")
+    parser.add_argument("--database-url", help="database for main.py; defaults to a temporary SQLite file")
+    parser.add_argument("--auto-create-schema", action="store_true", help="create the schema on every startup")
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency of the Spotify/Last.fm stand-ins")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+# --- Child process: one cold start ---
+
+async def first_request(app, path: str):
+    import httpx
+
+    # Startup hooks run on the first lifespan event, as on a fresh serverless instance.
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            response = await client.get(path)
+        return time.perf_counter() - started, response.status_code
+
+def run_child(target: str):
+    module_name, path = TARGETS[target]
+    sys.path[:0] = [ROOT, os.path.join(ROOT, "api")]
+    os.chdir(ROOT)
+    started = time.perf_counter()
+    module = __import__(module_name)
+    import_s = time.perf_counter() - started
+    startup_started = time.perf_counter()
+    request_s, status = asyncio.run(first_request(module.app, path))
+    first_request_s = time.perf_counter() - startup_started
+    print(json.dumps({
+        "import_s": import_s,
+        "startup_and_request_s": first_request_s,
+        "request_s": request_s,
+        "status": status,
+        "modules_loaded": len(sys.modules),
+    }))
+
+# --- Parent process ---
+
+def summarize(values: list[float]):
+    ordered = sorted(values)
+    return {
+        "median_s": statistics.median(ordered),
+        "p95_s": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "min_s": ordered[0],
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        run_child(args.child)
+        return
+
+    sys.path[:0] = [BENCH, ROOT]
+    from fakes import FakeConfig, FakeServer
+
+    fake = FakeServer(FakeConfig(latency_ms=args.latency_ms, jitter_ms=0, rate_204=0)).start()
+    tmpdir = tempfile.TemporaryDirectory()
+    database_url = args.database_url or f"sqlite:///{os.path.join(tmpdir.name, 'coldstart.db')}"
+    env = dict(
+        os.environ, **fake.env(),
+        DATABASE_URL=database_url,
+        AUTO_CREATE_SCHEMA="true" if args.auto_create_schema else "false",
+        LASTFM_API_KEY="bench", SPOTIFY_CLIENT_ID="bench", SPOTIFY_CLIENT_SECRET="bench",
+        IMAGE_CACHE_DIR=os.path.join(tmpdir.name, "images"),
+    )
+    try:
+        # The schema is created once up front, as the deploy step would.
+        subprocess.run(
+            [sys.executable, "-c", f"import sys; sys.path[:0] = {[BENCH, ROOT]!r}; "
+             "import database, seed; database.create_db_and_tables(); seed.seed(database.get_engine(), 10)"],
+            env=env, cwd=ROOT, check=True, capture_output=True,
+        )
+        results = {"config": {key: value for key, value in vars(args).items() if key != "child"}, "targets": {}}
+        for target in args.targets.split(","):
+            runs = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", target],
+                    env=env, cwd=ROOT, check=True, capture_output=True, text=True,
+                ).stdout
+                run = json.loads(output.strip().splitlines()[-1])
+                run["process_s"] = time.perf_counter() - started
+                runs.append(run)
+            results["targets"][target] = {
+                "status": sorted({run["status"] for run in runs}),
+                "modules_loaded": runs[-1]["modules_loaded"],
+                **{key: summarize([run[key] for run in runs])
+                   for key in ("import_s", "startup_and_request_s", "request_s", "process_s")},
+            }
+    finally:
+        fake.stop()
+        tmpdir.cleanup()
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return results
+
+if __name__ == "__main__":
+    main()
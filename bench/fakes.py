@@ -0,0 +1,246 @@
+"""
+Local stand-ins for the Spotify Web API, the Spotify accounts service and
+the Last.fm API, served by uvicorn on a background thread. Latency and the
+share of 204/429/5xx responses are configurable, so the benchmarks run
+without network access. `FakeRedis` stands in for a Redis server for the
+shared cache backend.
+"""
+import time
+import random
+import socket
+import asyncio
+import threading
+from urllib.parse import parse_qs
+from dataclasses import dataclass
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+@dataclass
+class FakeConfig:
+    latency_ms: float = 50          # mean added latency per request
+    jitter_ms: float = 10           # uniform +/- jitter on the latency
+    rate_204: float = 0.3           # share of currently-playing calls with nothing playing
+    rate_429: float = 0.0           # share of calls answered with 429
+    rate_5xx: float = 0.0           # share of calls answered with 503
+    retry_after: int = 1            # Retry-After sent with 429s
+    token_expires_in: int = 3600    # lifetime of refreshed access tokens
+    tracks: int = 500               # distinct tracks in the fake catalogue
+    seed: int = 1
+
+class FakeStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: dict[str, int] = {}
+
+    def hit(self, name: str):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+def _track(index: int):
+    return {
+        "id": f"track{index}",
+        "name": f"Track {index}",
+        "duration_ms": 120000 + (index % 120) * 1000,
+        "artists": [{"name": f"Artist {index % 97}"}],
+        "album": {"images": [{"url": f"https://i.scdn.co/image/fake{index}"}]},
+        "external_urls": {"spotify": f"https://open.spotify.com/track/track{index}"},
+    }
+
+def create_fake_app(config: FakeConfig, stats: FakeStats):
+    """One app serving the Spotify API (/v1), accounts (/api/token) and Last.fm (/2.0/)."""
+    app = FastAPI()
+    rng = random.Random(config.seed)
+    catalogue = [_track(i) for i in range(config.tracks)]
+
+    async def delay_or_fail(name: str):
+        stats.hit(name)
+        latency = max(0.0, config.latency_ms + rng.uniform(-config.jitter_ms, config.jitter_ms))
+        await asyncio.sleep(latency / 1000)
+        roll = rng.random()
+        if roll < config.rate_429:
+            stats.hit(f"{name}_429")
+            return JSONResponse({"error": "rate limited"}, status_code=429, headers={"Retry-After": str(config.retry_after)})
+        if roll < config.rate_429 + config.rate_5xx:
+            stats.hit(f"{name}_5xx")
+            return JSONResponse({"error": "unavailable"}, status_code=503)
+        return None
+
+    @app.post("/api/token")
+    async def token(request: Request):
+        failure = await delay_or_fail("token")
+        if failure:
+            return failure
+        # Parsed by hand so the fake does not need python-multipart.
+        form = parse_qs((await request.body()).decode())
+        refresh_token = form.get("refresh_token", [""])[0]
+        return {"access_token": f"at-{refresh_token}-{time.monotonic_ns()}", "expires_in": config.token_expires_in}
+
+    @app.get("/v1/me/player/currently-playing")
+    async def currently_playing(request: Request):
+        failure = await delay_or_fail("currently_playing")
+        if failure:
+            return failure
+        if rng.random() < config.rate_204:
+            return Response(status_code=204)
+        track = catalogue[hash(request.headers.get("authorization")) % len(catalogue)]
+        return {"is_playing": True, "progress_ms": rng.randint(0, track["duration_ms"]), "item": track}
+
+    @app.get("/v1/me")
+    async def me(request: Request):
+        failure = await delay_or_fail("me")
+        if failure:
+            return failure
+        return {"id": "fake-user", "display_name": "Fake User", "images": []}
+
+    @app.get("/2.0/")
+    async def lastfm(user: str, method: str):
+        failure = await delay_or_fail("lastfm")
+        if failure:
+            return failure
+        track = catalogue[hash(user) % len(catalogue)]
+        return {"recenttracks": {"track": [{
+            "name": track["name"],
+            "artist": {"#text": track["artists"][0]["name"]},
+            "url": track["external_urls"]["spotify"],
+            "image": [{"#text": ""}, {"#text": ""}, {"#text": ""}, {"#text": track["album"]["images"][0]["url"]}],
+            "@attr": {"nowplaying": "true"},
+        }]}}
+
+    return app
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class FakeServer:
+    """Runs the fake services on 127.0.0.1 in a daemon thread."""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.stats = FakeStats()
+        self.port = _free_port()
+        self.server = uvicorn.Server(uvicorn.Config(
+            create_fake_app(config, self.stats), host="127.0.0.1", port=self.port, log_level="warning",
+        ))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def env(self):
+        """Environment variables that point spotify.py and lastfm.py at this server."""
+        return {
+            "SPOTIFY_API_BASE_URL": f"{self.base_url}/v1",
+            "SPOTIFY_TOKEN_URL": f"{self.base_url}/api/token",
+            "LASTFM_API_BASE_URL": f"{self.base_url}/2.0/",
+        }
+
+    def start(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+class FakeRedis:
+    """
+    A minimal in-memory server for the Redis protocol (RESP2) on 127.0.0.1,
+    with the commands `cache.RedisBackend` sends: PING, AUTH, SELECT, GET,
+    SET with EX/PX, DEL and FLUSHALL. Runs in a daemon thread.
+    """
+
+    def __init__(self):
+        self.port = _free_port()
+        self.data: dict[bytes, tuple[bytes, float | None]] = {}
+        self.commands = 0
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._writers: set[asyncio.StreamWriter] = set()
+        self.thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    def env(self):
+        return {"CACHE_URL": self.url}
+
+    def _get(self, key: bytes):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _run(self, args: list[bytes]):
+        self.commands += 1
+        command = args[0].upper()
+        if command in (b"PING", b"AUTH", b"SELECT"):
+            return b"+PONG\r\n" if command == b"PING" else b"+OK\r\n"
+        if command == b"GET":
+            value = self._get(args[1])
+            return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+        if command == b"SET":
+            expires_at = None
+            options = [arg.upper() for arg in args[3:]]
+            for unit, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+                if unit in options:
+                    expires_at = time.monotonic() + float(args[3 + options.index(unit) + 1]) * scale
+            self.data[args[1]] = (args[2], expires_at)
+            return b"+OK\r\n"
+        if command == b"DEL":
+            return b":%d\r\n" % sum(self.data.pop(key, None) is not None for key in args[1:])
+        if command == b"FLUSHALL":
+            self.data.clear()
+            return b"+OK\r\n"
+        return b"-ERR unknown command\r\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                args = []
+                for _ in range(int(header[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                writer.write(self._run(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def start(self):
+        self.thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, "127.0.0.1", self.port), self._loop,
+        ).result()
+        return self
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            # Closing the connections ends their handlers, which read EOF.
+            for writer in list(self._writers):
+                writer.close()
+            handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            if handlers:
+                await asyncio.wait(handlers, timeout=1)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.thread.join(timeout=5)
+        self._loop.close()
@@ -0,0 +1,256 @@
+"""
+Load benchmark for the poll path (main.py) and the Last.fm read path (api/index.py).
+
+Starts the local Spotify/Last.fm stand-ins from bench/fakes.py, seeds the
+database and prints the results as JSON, so no network access is needed:
+
+    python bench/run.py --users 1000
+    python bench/run.py --users 10000 --latency-ms 80 --rate-429 0.01 --output results.json
+    python bench/run.py --users 100000 --database-url postgresql://localhost/bench
+    python bench/run.py --cache redis --read-instances 4   # shared cache across 4 api/index.py instances
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import importlib.util
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "api")]
+
+from fakes import FakeConfig, FakeRedis, FakeServer  # noqa: E402
+
+CRON_SECRET = "bench"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="users with an active share (e.g. 1000, 10000, 100000)")
+    parser.add_argument("--database-url", help="database to seed and poll; defaults to a temporary SQLite file")
+    parser.add_argument("--expired-ratio", type=float, default=0.1, help="share of tokens that are already expired")
+    parser.add_argument("--budget", type=float, default=8, help="seconds of polling per /tasks/update-playing invocation")
+    parser.add_argument("--chunk", type=int, default=100, help="most users per chunk (cursor checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=None, help="Spotify calls in flight per chunk")
+    parser.add_argument("--passes", type=int, default=1, help="full sweeps over all users")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--rate-204", type=float, default=0.3)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--token-expires-in", type=int, default=3600)
+    parser.add_argument("--read-requests", type=int, default=2000, help="requests sent to api/index.py")
+    parser.add_argument("--read-users", type=int, default=100, help="distinct Last.fm users those requests ask for")
+    parser.add_argument("--read-concurrency", type=int, default=50)
+    parser.add_argument("--read-instances", type=int, default=1, help="separate api/index.py instances the requests are spread over")
+    parser.add_argument("--cache", choices=("memory", "sqlite", "redis"), default="memory",
+                        help="CACHE_URL backend; redis runs against a local stand-in")
+    parser.add_argument("--rate-limit", type=float, default=100000, help="SPOTIFY_RATE_LIMIT for the run")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    return parser.parse_args(argv)
+
+def configure_env(args, fake: FakeServer, database_url: str, cache_url: str):
+    """Points every module at the stand-ins; must run before main or api/index.py is imported."""
+    os.environ.update(fake.env())
+    os.environ.update({
+        "DATABASE_URL": database_url,
+        "CACHE_URL": cache_url,
+        "CRON_SECRET": CRON_SECRET,
+        "SPOTIFY_CLIENT_ID": "bench",
+        "SPOTIFY_CLIENT_SECRET": "bench",
+        "SPOTIFY_RATE_LIMIT": str(args.rate_limit),
+        "SPOTIFY_RATE_BURST": str(int(args.rate_limit)),
+        "LASTFM_API_KEY": "bench",
+        "LASTFM_USERNAME": "bench0",
+    })
+
+def percentile(values: list[float], pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def summarize(durations: list[float]):
+    return {
+        "count": len(durations),
+        "mean_s": statistics.fmean(durations) if durations else None,
+        "p50_s": percentile(durations, 50),
+        "p95_s": percentile(durations, 95),
+        "max_s": max(durations) if durations else None,
+    }
+
+class QueryCounter:
+    """Counts statements sent to the database (one per execute/executemany) by every engine, sync or async."""
+
+    def __init__(self):
+        self.count = 0
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+async def bench_poll(args, main, queries: QueryCounter):
+    """Drives each cycle of /tasks/update-playing through its continuation requests, as the cron job would."""
+    import httpx
+
+    # The chain is driven from here instead of by the endpoint's own background request.
+    async def no_next_batch(*args, **kwargs):
+        pass
+    main.trigger_next_batch = no_next_batch
+
+    params = {"budget": args.budget, "chunk": args.chunk}
+    if args.concurrency:
+        params["concurrency"] = args.concurrency
+
+    passes = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(args.passes):
+            durations, round_trips, polled, chunks, failures, rate_limit = [], [], 0, 0, 0, None
+            cycle, started = None, time.perf_counter()
+            while True:
+                before = queries.count
+                invocation_started = time.perf_counter()
+                response = await client.post(
+                    "/tasks/update-playing", params={**params, **({"cycle": cycle} if cycle else {})},
+                    headers={"x-cron-secret": CRON_SECRET},
+                )
+                if response.status_code != 200:
+                    failures += 1
+                    break
+                body = response.json()
+                durations.append(time.perf_counter() - invocation_started)
+                round_trips.append(queries.count - before)
+                polled += body["polled"]
+                chunks += body["chunks"]
+                rate_limit = body["rate_limit"]
+                cycle = body["cycle"]
+                if body["finished"] or body["cycle"] is None or body["chunks"] == 0:
+                    break
+            elapsed = time.perf_counter() - started
+            passes.append({
+                "invocations": len(durations),
+                "chunks": chunks,
+                "polled": polled,
+                "failed_invocations": failures,
+                "wall_s": elapsed,
+                "users_per_s": args.users / elapsed if elapsed else None,
+                "polled_per_s": polled / elapsed if elapsed else None,
+                "invocation_wall": summarize(durations),
+                "db_round_trips": sum(round_trips),
+                "db_round_trips_per_chunk": sum(round_trips) / chunks if chunks else None,
+                "rate_limit": rate_limit,
+            })
+    return passes
+
+def load_instances(count: int):
+    """Imports api/index.py `count` times, as separate instances that share only CACHE_URL."""
+    instances = []
+    for i in range(count):
+        spec = importlib.util.spec_from_file_location(f"index_instance{i}", os.path.join(ROOT, "api", "index.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        instances.append(module)
+    return instances
+
+async def bench_read(args, instances: list):
+    """
+    Sends concurrent requests for `read_users` distinct users to
+    /api/now-playing/{username}, each to a random api/index.py instance.
+    """
+    import httpx
+
+    usernames = [f"bench{i % args.read_users}" for i in range(args.read_requests)]
+    latencies, statuses = [], {}
+    semaphore = asyncio.Semaphore(args.read_concurrency)
+    clients = [
+        httpx.AsyncClient(transport=httpx.ASGITransport(app=index.app), base_url="http://bench") for index in instances
+    ]
+    try:
+        async def one(instance: int, username: str):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await clients[instance].get(f"/api/now-playing/{username}")
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        rng = random.Random(1)
+        await asyncio.gather(*(one(rng.randrange(len(clients)), username) for username in usernames))
+        elapsed = time.perf_counter() - started
+    finally:
+        for client in clients:
+            await client.aclose()
+    caches = [index.now_playing_cache for index in instances]
+    return {
+        "requests": len(usernames),
+        "distinct_users": min(args.read_users, args.read_requests),
+        "wall_s": elapsed,
+        "qps": len(usernames) / elapsed if elapsed else None,
+        "latency": summarize(latencies),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "instances": len(instances),
+        "cache": {"hits": sum(cache.hits for cache in caches), "stale_hits": sum(cache.stale_hits for cache in caches),
+                  "misses": sum(cache.misses for cache in caches)},
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = FakeConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_204=args.rate_204,
+        rate_429=args.rate_429, rate_5xx=args.rate_5xx, token_expires_in=args.token_expires_in,
+    )
+    fake = FakeServer(config).start()
+    redis = FakeRedis().start() if args.cache == "redis" else None
+    tmpdir = tempfile.TemporaryDirectory()
+    database_url = args.database_url or f"sqlite:///{os.path.join(tmpdir.name, 'bench.db')}"
+    cache_url = {
+        "memory": "memory://",
+        "sqlite": f"sqlite:///{os.path.join(tmpdir.name, 'cache.db')}",
+        "redis": redis.url if redis else None,
+    }[args.cache]
+    configure_env(args, fake, database_url, cache_url)
+    # api/index.py mounts ./public relative to the working directory.
+    os.chdir(ROOT)
+
+    try:
+        import database
+        import seed
+        import main as app_main
+
+        database.create_db_and_tables()
+        seed_started = time.perf_counter()
+        seed.seed(database.get_engine(), args.users, expired_ratio=args.expired_ratio)
+        seed_s = time.perf_counter() - seed_started
+
+        queries = QueryCounter()
+        poll = asyncio.run(bench_poll(args, app_main, queries))
+        read = asyncio.run(bench_read(args, load_instances(args.read_instances)))
+
+        results = {
+            "config": {**vars(args), "database": database.get_engine().dialect.name},
+            "seed_s": seed_s,
+            "poll": poll,
+            "read": read,
+            "upstream_calls": dict(sorted(fake.stats.counts.items())),
+        }
+    finally:
+        fake.stop()
+        if redis:
+            redis.stop()
+        tmpdir.cleanup()
+
+    output = json.dumps(results, indent=2, default=str)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Seeds a database with benchmark users: one user, token and active share each.
+"""
+import random
+import datetime
+from sqlalchemy import insert, delete
+from sqlalchemy.engine import Engine
+from database import Base
+import models
+
+# Rows per INSERT, small enough for SQLite's bound-parameter limit.
+CHUNK_SIZE = 500
+
+def _chunks(rows: list[dict], size: int = CHUNK_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+def seed(engine: Engine, users: int, expired_ratio: float = 0.1, seed: int = 1):
+    """
+    Replaces the contents of every table with `users` sharing users.
+    `expired_ratio` of the tokens are already expired, so the first poll refreshes them.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    Base.metadata.create_all(bind=engine)
+
+    user_rows, token_rows, share_rows = [], [], []
+    for user_id in range(1, users + 1):
+        user_rows.append({"id": user_id, "spotify_id": f"bench{user_id}", "display_name": f"Bench User {user_id}"})
+        expired = rng.random() < expired_ratio
+        token_rows.append({
+            "user_id": user_id,
+            "access_token": f"access{user_id}",
+            "refresh_token": f"refresh{user_id}",
+            "expires_at": now - datetime.timedelta(minutes=5) if expired else now + datetime.timedelta(hours=1),
+        })
+        share_rows.append({"user_id": user_id, "expires_at": now + datetime.timedelta(hours=24)})
+
+    with engine.begin() as conn:
+        # Children before parents, so no foreign key is left dangling.
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(delete(table))
+        for model, rows in ((models.User, user_rows), (models.Token, token_rows), (models.ActiveShare, share_rows)):
+            for chunk in _chunks(rows):
+                conn.execute(insert(model), chunk)
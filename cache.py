@@ -0,0 +1,479 @@
+import os
+import time
+import struct
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote, urlsplit
+import metrics
+from asyncutil import SingleFlight
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Where the now-playing caches of main.py and api/index.py keep their entries:
+#   memory://                      - in this process only (default)
+#   sqlite:////tmp/np-cache.db     - a file shared by every process on the node
+#   redis://[:password@]host:6379/0, rediss://... - shared by every instance
+CACHE_URL = os.getenv("CACHE_URL", "memory://")
+# Most entries kept by the SQLite backend; the soonest to expire go first.
+CACHE_SQLITE_MAX_ENTRIES = int(os.getenv("CACHE_SQLITE_MAX_ENTRIES", "100000"))
+# Redis connections per process, and how long a command may take before it counts as a miss.
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "10"))
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+# After a connection failure, Redis is skipped (all misses) for this many seconds.
+REDIS_RETRY_INTERVAL = float(os.getenv("REDIS_RETRY_INTERVAL", "5"))
+
+_MISSING = object()
+
+class TTLCache:
+    """
+    A small thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    Once `maxsize` entries are stored, the least recently used one is
+    evicted. Expired entries are dropped lazily when they are read.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SWRCache:
+    """
+    An async read-through cache with stale-while-revalidate and single-flight loads.
+
+    A value is fresh for `ttl` seconds and is then served stale for up to
+    `stale_ttl` more seconds while one background task reloads it. A caller
+    passing `max_age` never gets a value older than that. Concurrent misses
+    for the same key share a single call to the loader. If a background
+    reload fails, the stale value is kept until it runs out.
+
+    Values are bytes and live in `backend` (see `make_backend`); with a
+    shared backend, a value loaded by one instance is served by all of them.
+    By default they are kept in process, at most `maxsize` keys, least
+    recently used first out.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 15, stale_ttl: float = 60, backend=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.backend = backend if backend is not None else MemoryBackend(maxsize)
+        self._loads = SingleFlight()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def invalidate(self, key: str):
+        await self.backend.delete(key)
+
+    async def set_many(self, items: dict[str, bytes]):
+        """Stores fresh values without calling a loader, e.g. when their producer writes them through."""
+        loaded_at = _LOADED_AT.pack(time.time())
+        await self.backend.set_many({key: loaded_at + value for key, value in items.items()}, self.ttl + self.stale_ttl)
+
+    async def get(self, key: str, loader, max_age: float | None = None):
+        """
+        Returns the value for `key`, calling the async `loader()` to (re)load it
+        when needed. With `max_age`, older values are reloaded before returning.
+        """
+        ttl = self.ttl if max_age is None else min(max_age, self.ttl)
+        stale_ttl = self.stale_ttl if max_age is None else 0
+        entry = await self.backend.get(key)
+        if entry is not None:
+            # Entries carry their load time as wall-clock time, which every instance agrees on.
+            (loaded_at,), value = _LOADED_AT.unpack_from(entry), entry[_LOADED_AT.size:]
+            age = time.time() - loaded_at
+            if age < ttl:
+                self.hits += 1
+                return value
+            if age < ttl + stale_ttl:
+                self.stale_hits += 1
+                if self._loads.running(key) is None:
+                    task = asyncio.ensure_future(self._loads.do(key, lambda: self._load(key, loader)))
+                    # A failed background reload keeps the stale value; don't log it as unhandled.
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                return value
+
+        self.misses += 1
+        return await self._loads.do(key, lambda: self._load(key, loader))
+
+    async def _load(self, key: str, loader):
+        value = await loader()
+        await self.backend.set(key, _LOADED_AT.pack(time.time()) + value, self.ttl + self.stale_ttl)
+        return value
+
+_LOADED_AT = struct.Struct("!d")
+
+# --- Backends ---
+#
+# Every backend stores bytes under string keys with a TTL, behind the same
+# async get/set/set_many/delete methods, and counts its hits and misses.
+# The shared backends treat their own failures as misses, so an unreachable
+# cache costs hit rate, never a failed request.
+
+class MemoryBackend:
+    """Keeps entries in this process, in a `TTLCache` of at most `maxsize` keys."""
+
+    def __init__(self, maxsize: int = 1024):
+        self._cache = TTLCache(maxsize=maxsize)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    async def get(self, key: str):
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._cache.set(key, value, ttl=ttl)
+
+    async def set_many(self, items: dict[str, bytes], ttl: float):
+        for key, value in items.items():
+            self._cache.set(key, value, ttl=ttl)
+
+    async def delete(self, key: str):
+        self._cache.invalidate(key)
+
+class SQLiteBackend:
+    """
+    Keeps entries in one SQLite file shared by every process on the node,
+    read through a memory map. Suits single-node deployments running several
+    workers; expired and surplus entries are pruned every `prune_every` writes.
+    """
+
+    def __init__(self, path: str, namespace: str = "", max_entries: int = CACHE_SQLITE_MAX_ENTRIES, prune_every: int = 1000):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # One connection per thread; autocommit, so readers never hold a transaction open.
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("PRAGMA mmap_size=268435456")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_cache_entries_expires_at ON cache_entries (expires_at)")
+            self._local.connection = connection
+        return connection
+
+    def _get(self, key: str):
+        row = self._connection().execute(
+            "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?", (self.namespace + key, time.time())
+        ).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def _set_many(self, items: dict[str, bytes], ttl: float):
+        connection = self._connection()
+        expires_at = time.time() + ttl
+        connection.executemany(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+            [(self.namespace + key, value, expires_at) for key, value in items.items()],
+        )
+        self._writes += len(items)
+        if self._writes >= self.prune_every:
+            self._writes = 0
+            self._prune(connection)
+
+    def _prune(self, connection):
+        connection.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+        (count,) = connection.execute("SELECT count(*) FROM cache_entries").fetchone()
+        if count > self.max_entries:
+            connection.execute(
+                "DELETE FROM cache_entries WHERE key IN "
+                "(SELECT key FROM cache_entries ORDER BY expires_at LIMIT ?)",
+                (count - int(self.max_entries * 0.9),),
+            )
+
+    def _delete(self, key: str):
+        self._connection().execute("DELETE FROM cache_entries WHERE key = ?", (self.namespace + key,))
+
+    async def get(self, key: str):
+        try:
+            value = await asyncio.to_thread(self._get, key)
+        except sqlite3.Error as e:
+            metrics.record_error("cache_sqlite", e)
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.set_many({key: value}, ttl)
+
+    async def set_many(self, items: dict[str, bytes], ttl: float):
+        if not items:
+            return
+        try:
+            await asyncio.to_thread(self._set_many, items, ttl)
+        except sqlite3.Error as e:
+            metrics.record_error("cache_sqlite", e)
+
+    async def delete(self, key: str):
+        try:
+            await asyncio.to_thread(self._delete, key)
+        except sqlite3.Error as e:
+            metrics.record_error("cache_sqlite", e)
+
+class RedisError(Exception):
+    """An error reply from the Redis server."""
+
+class _RedisConnection:
+    """One connection speaking RESP2, the protocol of Redis, Valkey, KeyDB and Dragonfly."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @staticmethod
+    def encode(args: tuple):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            return RedisError(payload.decode(errors="replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            return None if length < 0 else (await self.reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            length = int(payload)
+            return None if length < 0 else [await self.read_reply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected Redis reply: {line[:32]!r}")
+
+    async def pipeline(self, commands: list[tuple]):
+        """Sends every command at once and returns their replies, in order; error replies are `RedisError`s."""
+        self.writer.write(b"".join(self.encode(command) for command in commands))
+        await self.writer.drain()
+        return [await self.read_reply() for _ in commands]
+
+    async def execute(self, *args):
+        (reply,) = await self.pipeline([args])
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    def close(self):
+        self.writer.close()
+
+class RedisBackend:
+    """
+    Keeps entries in Redis, so every instance of every service shares them.
+    Speaks the protocol directly over asyncio streams, keeps up to
+    `pool_size` connections per process and batches `set_many` into one
+    round trip. Set an eviction policy such as allkeys-lru on the server.
+    """
+
+    def __init__(self, url: str, namespace: str = "", pool_size: int = REDIS_POOL_SIZE, timeout: float = REDIS_TIMEOUT):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.tls = parts.scheme == "rediss"
+        self.namespace = namespace
+        self.pool_size = pool_size
+        self.timeout = timeout
+        # Connections belong to the event loop that opened them.
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._idle: list[_RedisConnection] = []
+        self._open = 0
+        self._available: asyncio.Condition | None = None
+        self._down_until = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    async def _connect(self):
+        tls_context = None
+        if self.tls:
+            # Imported here, so cold starts without rediss:// skip it.
+            import ssl
+            tls_context = ssl.create_default_context()
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=tls_context)
+        connection = _RedisConnection(reader, writer)
+        try:
+            if self.password:
+                await connection.execute("AUTH", *([self.username] if self.username else []), self.password)
+            if self.db:
+                await connection.execute("SELECT", self.db)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    async def _acquire(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._idle, self._open = loop, [], 0
+            self._available = asyncio.Condition()
+        async with self._available:
+            while not self._idle and self._open >= self.pool_size:
+                await asyncio.wait_for(self._available.wait(), self.timeout)
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+        try:
+            return await asyncio.wait_for(self._connect(), self.timeout)
+        except asyncio.TimeoutError:
+            await self._release(None)
+            raise ConnectionError("Timed out connecting to Redis")
+        except BaseException:
+            await self._release(None)
+            raise
+
+    async def _release(self, connection: _RedisConnection | None):
+        async with self._available:
+            if connection is None:
+                self._open -= 1
+            else:
+                self._idle.append(connection)
+            self._available.notify()
+
+    async def _pipeline(self, commands: list[tuple]):
+        """Runs `commands` on a pooled connection; returns None (and skips Redis for a while) on failure."""
+        if time.monotonic() < self._down_until:
+            return None
+        try:
+            connection = await self._acquire()
+        except asyncio.TimeoutError as e:
+            # Every pooled connection is busy.
+            metrics.record_error("cache_redis", e)
+            return None
+        except (OSError, RedisError) as e:
+            metrics.record_error("cache_redis", e)
+            self._down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+            return None
+        try:
+            replies = await asyncio.wait_for(connection.pipeline(commands), self.timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            # The connection may still have replies in flight; never reuse it.
+            metrics.record_error("cache_redis", e)
+            connection.close()
+            await self._release(None)
+            return None
+        except BaseException:
+            connection.close()
+            await self._release(None)
+            raise
+        await self._release(connection)
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                metrics.record_error("cache_redis", reply)
+        return replies
+
+    async def get(self, key: str):
+        replies = await self._pipeline([("GET", self.namespace + key)])
+        value = replies[0] if replies and isinstance(replies[0], bytes) else None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.set_many({key: value}, ttl)
+
+    async def set_many(self, items: dict[str, bytes], ttl: float):
+        if items:
+            ttl_ms = max(1, int(ttl * 1000))
+            await self._pipeline([("SET", self.namespace + key, value, "PX", ttl_ms) for key, value in items.items()])
+
+    async def delete(self, key: str):
+        await self._pipeline([("DEL", self.namespace + key)])
+
+def make_backend(url: str = CACHE_URL, namespace: str = "", maxsize: int = 1024):
+    """
+    The backend named by `url` (see CACHE_URL). `namespace` prefixes the keys
+    in shared backends; `maxsize` bounds the in-memory one.
+    """
+    scheme = urlsplit(url).scheme
+    if scheme == "memory":
+        return MemoryBackend(maxsize)
+    if scheme == "sqlite":
+        # sqlite:///relative.db or sqlite:////absolute/path.db, as in DATABASE_URL
+        return SQLiteBackend(url.split(":///", 1)[1], namespace=namespace)
+    if scheme in ("redis", "rediss"):
+        return RedisBackend(url, namespace=namespace)
+    raise ValueError(f"Unknown CACHE_URL scheme: {scheme!r} (expected memory, sqlite, redis or rediss)")
+
+# --- HTTP revalidation ---
+
+def make_etag(body: bytes):
+    """A strong ETag for a response body."""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+def etag_matches(if_none_match: str | None, etag: str):
+    """Whether an `If-None-Match` header matches `etag` (weak comparison, as RFC 9110 requires)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
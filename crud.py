@@ -1,12 +1,18 @@
+from sqlalchemy import bindparam, func, or_, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
 import models
+import metrics
 import datetime
 
 # --- User CRUD ---
 
+@metrics.timed_db
 def get_user_by_spotify_id(db: Session, spotify_id: str):
     return db.query(models.User).filter(models.User.spotify_id == spotify_id).first()
 
+@metrics.timed_db
 def create_user(db: Session, spotify_id: str, display_name: str, profile_pic_url: str | None):
     db_user = models.User(
         spotify_id=spotify_id,
@@ -18,11 +24,45 @@ def create_user(db: Session, spotify_id: str, display_name: str, profile_pic_url
     db.refresh(db_user)
     return db_user
 
+@metrics.timed_db
+def set_lastfm_username(db: Session, user_id: int, lastfm_username: str | None):
+    db.query(models.User).filter(models.User.id == user_id).update({"lastfm_username": lastfm_username})
+    db.commit()
+
 # --- Token CRUD ---
 
+@metrics.timed_db
 def get_token_by_user_id(db: Session, user_id: int):
     return db.query(models.Token).filter(models.Token.user_id == user_id).first()
 
+@metrics.timed_db
+def get_tokens_by_user_ids(db: Session, user_ids: list[int]):
+    if not user_ids:
+        return []
+    return db.query(models.Token).filter(models.Token.user_id.in_(user_ids)).all()
+
+@metrics.timed_db
+def get_expiring_tokens(
+    db: Session,
+    before: datetime.datetime,
+    limit: int = 500,
+    shards: list[int] | None = None,
+    shard_count: int = 1,
+):
+    """
+    Returns tokens of actively sharing users that expire before `before`, soonest first.
+    With `shards`, only users with `user_id % shard_count` in `shards` are returned.
+    """
+    query = (
+        db.query(models.Token)
+        .join(models.ActiveShare, models.ActiveShare.user_id == models.Token.user_id)
+        .filter(models.Token.expires_at < before, models.ActiveShare.expires_at > datetime.datetime.utcnow())
+    )
+    if shards is not None:
+        query = query.filter((models.Token.user_id % shard_count).in_(shards))
+    return query.order_by(models.Token.expires_at).limit(limit).all()
+
+@metrics.timed_db
 def create_or_update_token(
     db: Session,
     user_id: int,
@@ -49,6 +89,7 @@ def create_or_update_token(
 
 # --- Track CRUD ---
 
+@metrics.timed_db
 def create_or_update_track(db: Session, user_id: int, track_data: dict):
     db_track = db.query(models.Track).filter(models.Track.user_id == user_id).first()
     if db_track:
@@ -64,8 +105,208 @@ def create_or_update_track(db: Session, user_id: int, track_data: dict):
     db.refresh(db_track)
     return db_track
 
+@metrics.timed_db
+def get_user_and_track_by_spotify_id(db: Session, spotify_id: str):
+    """Returns `(user, track)` for the user, with `track` None if nothing was stored yet, or None."""
+    return (
+        db.query(models.User, models.Track)
+        .outerjoin(models.Track, models.Track.user_id == models.User.id)
+        .filter(models.User.spotify_id == spotify_id)
+        .first()
+    )
+
+# --- Bulk writes (poller) ---
+#
+# These take a whole batch of rows, write them with a native upsert and do
+# not commit or re-read anything, so the caller can put every write of a
+# cron batch into a single transaction.
+
+TOKEN_COLUMNS = ("access_token", "refresh_token", "expires_at")
+TRACK_COLUMNS = (
+    "track_name", "artist_name", "album_cover_url", "spotify_track_url", "currently_playing",
+    "spotify_track_id", "updated_at",
+)
+
+def _upsert_insert(db: Session):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    return None
+
+def _bulk_upsert(db: Session, model, rows: list[dict], columns: tuple[str, ...]):
+    if not rows:
+        return
+    insert = _upsert_insert(db)
+    if insert is None:
+        # No native upsert on this backend; merge row by row in the same transaction.
+        for row in rows:
+            db_row = db.query(model).filter(model.user_id == row["user_id"]).first()
+            if db_row:
+                for column in columns:
+                    setattr(db_row, column, row[column])
+            else:
+                db.add(model(**row))
+        db.flush()
+        return
+    stmt = insert(model.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={column: stmt.excluded[column] for column in columns},
+    )
+    db.execute(stmt, rows)
+
+@metrics.timed_db
+def bulk_upsert_tokens(db: Session, tokens: list[dict]):
+    """Upserts `{"user_id", "access_token", "refresh_token", "expires_at"}` rows. Does not commit."""
+    _bulk_upsert(db, models.Token, tokens, TOKEN_COLUMNS)
+
+@metrics.timed_db
+def bulk_upsert_tracks(db: Session, tracks: list[dict]):
+    """Upserts `{"user_id", **track_data}` rows. Does not commit."""
+    _bulk_upsert(db, models.Track, tracks, TRACK_COLUMNS)
+
+@metrics.timed_db
+def bulk_update_poll_failures(db: Session, failures: list[dict]):
+    """
+    Sets `{"share_id", "consecutive_errors", "last_error", "next_eligible_at"}`
+    on each share, by primary key in one executemany. Does not commit.
+    """
+    if failures:
+        db.execute(
+            update(models.ActiveShare.__table__)
+            .where(models.ActiveShare.__table__.c.id == bindparam("share_id"))
+            .values(
+                consecutive_errors=bindparam("consecutive_errors"),
+                last_error=bindparam("last_error"),
+                next_eligible_at=bindparam("next_eligible_at"),
+            ),
+            failures,
+        )
+
+@metrics.timed_db
+def bulk_update_poll_schedules(db: Session, schedules: list[dict]):
+    """
+    Sets `{"share_id", "next_poll_at", "idle_streak"}` on each share after a
+    successful poll, clearing its failure backoff, by primary key in one
+    executemany. Does not commit.
+    """
+    if schedules:
+        db.execute(
+            update(models.ActiveShare.__table__)
+            .where(models.ActiveShare.__table__.c.id == bindparam("share_id"))
+            .values(
+                next_poll_at=bindparam("next_poll_at"),
+                idle_streak=bindparam("idle_streak"),
+                consecutive_errors=0,
+                last_error=None,
+                next_eligible_at=None,
+            ),
+            schedules,
+        )
+
+@metrics.timed_db
+def bulk_stop_sharing(db: Session, user_ids: list[int]):
+    """Deletes the active shares of every given user. Does not commit."""
+    if user_ids:
+        db.query(models.ActiveShare).filter(models.ActiveShare.user_id.in_(user_ids)).delete(synchronize_session=False)
+
+# --- Listening history ---
+
+PLAY_COLUMNS = ("user_id", "spotify_track_id", "track_name", "artist_name", "started_at")
+
+def _increment_rollup(db: Session, model, keys: tuple[str, ...], rows: list[dict]):
+    """Adds each row's `plays` to the rollup row with the same `keys`, creating it if needed."""
+    if not rows:
+        return
+    insert = _upsert_insert(db)
+    if insert is None:
+        for row in rows:
+            db_row = db.query(model).filter_by(**{key: row[key] for key in keys}).first()
+            if db_row:
+                db_row.plays += row["plays"]
+            else:
+                db.add(model(**row))
+        db.flush()
+        return
+    stmt = insert(model.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={"plays": model.__table__.c.plays + stmt.excluded.plays},
+    )
+    db.execute(stmt, rows)
+
+@metrics.timed_db
+def record_plays(db: Session, plays: list[dict]):
+    """
+    Appends plays built by `poller.build_play` to the history and adds them
+    to the daily track and artist rollups. Does not commit.
+    """
+    if not plays:
+        return
+    db.execute(models.Play.__table__.insert(), [{column: play[column] for column in PLAY_COLUMNS} for play in plays])
+
+    # Pre-aggregate the batch so each rollup row is written once.
+    tracks, artists = {}, {}
+    for play in plays:
+        day = play["started_at"].date()
+        key = (play["user_id"], day, play["spotify_track_id"])
+        if key not in tracks:
+            tracks[key] = {
+                "user_id": play["user_id"], "day": day, "spotify_track_id": play["spotify_track_id"],
+                "track_name": play["track_name"], "artist_name": play["artist_name"], "plays": 0,
+            }
+        tracks[key]["plays"] += 1
+        for artist in play["artists"]:
+            key = (play["user_id"], day, artist)
+            if key not in artists:
+                artists[key] = {"user_id": play["user_id"], "day": day, "artist_name": artist, "plays": 0}
+            artists[key]["plays"] += 1
+
+    _increment_rollup(db, models.DailyTrackPlays, ("user_id", "day", "spotify_track_id"), list(tracks.values()))
+    _increment_rollup(db, models.DailyArtistPlays, ("user_id", "day", "artist_name"), list(artists.values()))
+
+@metrics.timed_db
+def get_top_tracks(db: Session, user_id: int, since: datetime.date, limit: int = 10):
+    """Most played tracks of a user since `since`, read from the daily rollup."""
+    plays = func.sum(models.DailyTrackPlays.plays).label("plays")
+    return (
+        db.query(
+            models.DailyTrackPlays.spotify_track_id,
+            func.max(models.DailyTrackPlays.track_name).label("track_name"),
+            func.max(models.DailyTrackPlays.artist_name).label("artist_name"),
+            plays,
+        )
+        .filter(models.DailyTrackPlays.user_id == user_id, models.DailyTrackPlays.day >= since)
+        .group_by(models.DailyTrackPlays.spotify_track_id)
+        .order_by(plays.desc())
+        .limit(limit)
+        .all()
+    )
+
+@metrics.timed_db
+def get_top_artists(db: Session, user_id: int, since: datetime.date, limit: int = 10):
+    """Most played artists of a user since `since`, read from the daily rollup."""
+    plays = func.sum(models.DailyArtistPlays.plays).label("plays")
+    return (
+        db.query(models.DailyArtistPlays.artist_name, plays)
+        .filter(models.DailyArtistPlays.user_id == user_id, models.DailyArtistPlays.day >= since)
+        .group_by(models.DailyArtistPlays.artist_name)
+        .order_by(plays.desc())
+        .limit(limit)
+        .all()
+    )
+
+@metrics.timed_db
+def prune_plays(db: Session, before: datetime.date):
+    """Deletes raw plays that started before the day `before`; rollups are kept. Does not commit."""
+    cutoff = datetime.datetime.combine(before, datetime.time.min)
+    return db.query(models.Play).filter(models.Play.started_at < cutoff).delete(synchronize_session=False)
+
 # --- ActiveShare & Feed CRUD ---
 
+@metrics.timed_db
 def start_sharing(db: Session, user_id: int):
     # Stop any previous share to ensure uniqueness
     stop_sharing(db, user_id)
@@ -76,10 +317,227 @@ def start_sharing(db: Session, user_id: int):
     db.refresh(db_active_share)
     return db_active_share
 
+@metrics.timed_db
 def stop_sharing(db: Session, user_id: int):
     db.query(models.ActiveShare).filter(models.ActiveShare.user_id == user_id).delete()
     db.commit()
 
+@metrics.timed_db
+def get_poll_batch(
+    db: Session,
+    after_id: int = 0,
+    limit: int = 20,
+    shards: list[int] | None = None,
+    shard_count: int = 1,
+):
+    """
+    Returns the next `limit` unexpired shares to poll after share id `after_id`, joined
+    with their user and stored track state in a single query. Tokens come
+    from `token_manager`, so the poll path does not read the tokens table.
+
+    Each row has `share_id`, `user_id`, `spotify_id`, `consecutive_errors`,
+    `idle_streak`, `spotify_track_id` and `currently_playing` (the last two
+    are None when the user has no track yet). Shares backed off after failed
+    polls are skipped until their `next_eligible_at`, and shares the
+    scheduler has no reason to poll yet until their `next_poll_at`. Keyset pagination keeps the cost of a batch independent of its
+    position and does not skip or repeat users when shares start or stop.
+    With `shards`, only users with `user_id % shard_count` in `shards` are returned.
+    """
+    now = datetime.datetime.utcnow()
+    query = (
+        db.query(
+            models.ActiveShare.id.label("share_id"),
+            models.User.id.label("user_id"),
+            models.User.spotify_id,
+            models.ActiveShare.consecutive_errors,
+            models.ActiveShare.idle_streak,
+            models.Track.spotify_track_id,
+            models.Track.currently_playing,
+        )
+        .join(models.User, models.User.id == models.ActiveShare.user_id)
+        .outerjoin(models.Track, models.Track.user_id == models.ActiveShare.user_id)
+        .filter(
+            models.ActiveShare.id > after_id,
+            models.ActiveShare.expires_at > now,
+            or_(models.ActiveShare.next_eligible_at.is_(None), models.ActiveShare.next_eligible_at <= now),
+            or_(models.ActiveShare.next_poll_at.is_(None), models.ActiveShare.next_poll_at <= now),
+        )
+    )
+    if shards is not None:
+        query = query.filter((models.ActiveShare.user_id % shard_count).in_(shards))
+    return query.order_by(models.ActiveShare.id).limit(limit).all()
+
+@metrics.timed_db
 def get_active_shares(db: Session):
     return db.query(models.ActiveShare).filter(models.ActiveShare.expires_at > datetime.datetime.utcnow()).all()
 
+@metrics.timed_db
+def delete_expired_shares(db: Session, now: datetime.datetime, limit: int = 1000):
+    """
+    Deletes up to `limit` shares that expired before `now`, oldest first, and
+    returns the user ids they belonged to. Does not commit.
+    """
+    expired = (
+        db.query(models.ActiveShare.id, models.ActiveShare.user_id)
+        .filter(models.ActiveShare.expires_at <= now)
+        .order_by(models.ActiveShare.expires_at)
+        .limit(limit)
+        .all()
+    )
+    if expired:
+        share_ids = [share_id for share_id, _ in expired]
+        db.query(models.ActiveShare).filter(models.ActiveShare.id.in_(share_ids)).delete(synchronize_session=False)
+    return [user_id for _, user_id in expired]
+
+# --- Shard leases (worker.py) ---
+#
+# Lease changes are coordination between processes, so each function
+# commits right away instead of joining the caller's transaction.
+
+@metrics.timed_db
+def ensure_shards(db: Session, shard_count: int):
+    """Creates the lease rows for shards 0..shard_count-1 that do not exist yet."""
+    existing = {shard for (shard,) in db.query(models.ShardLease.shard)}
+    missing = [{"shard": shard} for shard in range(shard_count) if shard not in existing]
+    if not missing:
+        return
+    try:
+        db.execute(models.ShardLease.__table__.insert(), missing)
+        db.commit()
+    except IntegrityError:
+        # Another worker created them first.
+        db.rollback()
+
+@metrics.timed_db
+def heartbeat_worker(db: Session, worker_id: str, now: datetime.datetime):
+    db.merge(models.PollWorker(id=worker_id, heartbeat_at=now))
+    db.commit()
+
+@metrics.timed_db
+def count_live_workers(db: Session, since: datetime.datetime):
+    """Counts workers that heartbeated after `since` and deletes the ones that have not for long."""
+    db.query(models.PollWorker).filter(
+        models.PollWorker.heartbeat_at < since - datetime.timedelta(hours=1)
+    ).delete(synchronize_session=False)
+    db.commit()
+    return db.query(models.PollWorker).filter(models.PollWorker.heartbeat_at >= since).count()
+
+@metrics.timed_db
+def get_shard_leases(db: Session, shard_count: int):
+    return db.query(models.ShardLease).filter(models.ShardLease.shard < shard_count).order_by(models.ShardLease.shard).all()
+
+@metrics.timed_db
+def renew_shards(db: Session, owner: str, now: datetime.datetime, expires_at: datetime.datetime):
+    """Extends every unexpired lease held by `owner` and returns the shards it still holds."""
+    db.query(models.ShardLease).filter(
+        models.ShardLease.owner == owner, models.ShardLease.expires_at >= now
+    ).update({"expires_at": expires_at}, synchronize_session=False)
+    db.commit()
+    return [
+        shard for (shard,) in db.query(models.ShardLease.shard)
+        .filter(models.ShardLease.owner == owner, models.ShardLease.expires_at >= expires_at)
+    ]
+
+@metrics.timed_db
+def try_claim_shard(db: Session, shard: int, owner: str, now: datetime.datetime, expires_at: datetime.datetime):
+    """
+    Takes the lease of a free or expired shard. The check and the write are
+    one UPDATE, so when workers race for a shard exactly one of them wins.
+    """
+    claimed = db.query(models.ShardLease).filter(
+        models.ShardLease.shard == shard,
+        or_(models.ShardLease.owner.is_(None), models.ShardLease.expires_at < now),
+    ).update({"owner": owner, "expires_at": expires_at}, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+@metrics.timed_db
+def release_shards(db: Session, owner: str, shards: list[int] | None = None):
+    """Gives up `owner`'s leases on `shards` (all of them by default) and, for all, its worker row."""
+    query = db.query(models.ShardLease).filter(models.ShardLease.owner == owner)
+    if shards is not None:
+        query = query.filter(models.ShardLease.shard.in_(shards))
+    else:
+        db.query(models.PollWorker).filter(models.PollWorker.id == owner).delete(synchronize_session=False)
+    query.update({"owner": None, "expires_at": None}, synchronize_session=False)
+    db.commit()
+
+# --- Poll cycles (/tasks/update-playing) ---
+#
+# Like the shard leases, cycle changes commit right away: a checkpoint must
+# survive the invocation that wrote it.
+
+@metrics.timed_db
+def get_latest_poll_cycle(db: Session):
+    return db.query(models.PollCycle).order_by(models.PollCycle.id.desc()).first()
+
+@metrics.timed_db
+def start_poll_cycle(db: Session, cycle_id: int, owner: str, now: datetime.datetime, locked_until: datetime.datetime, keep: int = 100):
+    """
+    Creates cycle `cycle_id`, locked by `owner`, and deletes all but the last
+    `keep` cycles. Returns False when another invocation created it first.
+    """
+    try:
+        db.add(models.PollCycle(
+            id=cycle_id, cursor=0, polled=0, invocations=1, owner=owner, locked_until=locked_until, started_at=now,
+        ))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False
+    db.query(models.PollCycle).filter(models.PollCycle.id <= cycle_id - keep).delete(synchronize_session=False)
+    db.commit()
+    return True
+
+@metrics.timed_db
+def try_lock_poll_cycle(db: Session, cycle_id: int, owner: str, now: datetime.datetime, locked_until: datetime.datetime):
+    """
+    Locks an unfinished cycle that nobody holds, in one UPDATE, so exactly
+    one racing invocation wins. Returns the cycle as it is now, or None
+    when it could not be locked.
+    """
+    locked = db.query(models.PollCycle).filter(
+        models.PollCycle.id == cycle_id,
+        models.PollCycle.finished_at.is_(None),
+        or_(models.PollCycle.locked_until.is_(None), models.PollCycle.locked_until < now),
+    ).update({
+        "owner": owner, "locked_until": locked_until, "invocations": models.PollCycle.invocations + 1,
+    }, synchronize_session=False)
+    db.commit()
+    if locked != 1:
+        return None
+    return db.query(models.PollCycle).populate_existing().filter(models.PollCycle.id == cycle_id).one()
+
+@metrics.timed_db
+def checkpoint_poll_cycle(
+    db: Session,
+    cycle_id: int,
+    owner: str,
+    cursor: int,
+    polled: int,
+    seconds_per_user: float | None,
+    now: datetime.datetime,
+    finished: bool = False,
+):
+    """
+    Saves the cursor after a chunk, adding `polled` to the cycle's count, and
+    unlocks the cycle when it is `finished`. Returns False, writing nothing,
+    when `owner` no longer holds the lock.
+    """
+    values = {"cursor": cursor, "polled": models.PollCycle.polled + polled, "checkpointed_at": now}
+    if seconds_per_user is not None:
+        values["seconds_per_user"] = seconds_per_user
+    if finished:
+        values.update({"finished_at": now, "owner": None, "locked_until": None})
+    saved = db.query(models.PollCycle).filter(
+        models.PollCycle.id == cycle_id, models.PollCycle.owner == owner,
+    ).update(values, synchronize_session=False)
+    db.commit()
+    return saved == 1
+
+@metrics.timed_db
+def unlock_poll_cycle(db: Session, cycle_id: int, owner: str):
+    db.query(models.PollCycle).filter(
+        models.PollCycle.id == cycle_id, models.PollCycle.owner == owner,
+    ).update({"owner": None, "locked_until": None}, synchronize_session=False)
+    db.commit()
@@ -0,0 +1,74 @@
+"""
+Async versions of the crud.py functions, taking an `AsyncSession`.
+
+Each one runs its crud.py counterpart through `AsyncSession.run_sync`, so
+the queries are the same, but every wait on the database yields to the
+event loop instead of blocking it. Commit with `await db.commit()`.
+"""
+import functools
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud
+
+def run_sync(func):
+    """Wraps a function taking a sync `Session` into a coroutine function taking an `AsyncSession`."""
+    @functools.wraps(func)
+    async def wrapper(db: AsyncSession, *args, **kwargs):
+        return await db.run_sync(func, *args, **kwargs)
+    return wrapper
+
+# --- User CRUD ---
+
+get_user_by_spotify_id = run_sync(crud.get_user_by_spotify_id)
+create_user = run_sync(crud.create_user)
+
+# --- Token CRUD ---
+
+get_token_by_user_id = run_sync(crud.get_token_by_user_id)
+get_tokens_by_user_ids = run_sync(crud.get_tokens_by_user_ids)
+get_expiring_tokens = run_sync(crud.get_expiring_tokens)
+create_or_update_token = run_sync(crud.create_or_update_token)
+
+# --- Track CRUD ---
+
+create_or_update_track = run_sync(crud.create_or_update_track)
+get_user_and_track_by_spotify_id = run_sync(crud.get_user_and_track_by_spotify_id)
+
+# --- Bulk writes (poller) ---
+
+bulk_upsert_tokens = run_sync(crud.bulk_upsert_tokens)
+bulk_upsert_tracks = run_sync(crud.bulk_upsert_tracks)
+bulk_update_poll_failures = run_sync(crud.bulk_update_poll_failures)
+bulk_stop_sharing = run_sync(crud.bulk_stop_sharing)
+
+# --- Listening history ---
+
+record_plays = run_sync(crud.record_plays)
+get_top_tracks = run_sync(crud.get_top_tracks)
+get_top_artists = run_sync(crud.get_top_artists)
+prune_plays = run_sync(crud.prune_plays)
+
+# --- ActiveShare & Feed CRUD ---
+
+start_sharing = run_sync(crud.start_sharing)
+stop_sharing = run_sync(crud.stop_sharing)
+get_poll_batch = run_sync(crud.get_poll_batch)
+get_active_shares = run_sync(crud.get_active_shares)
+delete_expired_shares = run_sync(crud.delete_expired_shares)
+
+# --- Shard leases (worker.py) ---
+
+ensure_shards = run_sync(crud.ensure_shards)
+heartbeat_worker = run_sync(crud.heartbeat_worker)
+count_live_workers = run_sync(crud.count_live_workers)
+get_shard_leases = run_sync(crud.get_shard_leases)
+renew_shards = run_sync(crud.renew_shards)
+try_claim_shard = run_sync(crud.try_claim_shard)
+release_shards = run_sync(crud.release_shards)
+
+# --- Poll cycles (/tasks/update-playing) ---
+
+get_latest_poll_cycle = run_sync(crud.get_latest_poll_cycle)
+start_poll_cycle = run_sync(crud.start_poll_cycle)
+try_lock_poll_cycle = run_sync(crud.try_lock_poll_cycle)
+checkpoint_poll_cycle = run_sync(crud.checkpoint_poll_cycle)
+unlock_poll_cycle = run_sync(crud.unlock_poll_cycle)
@@ -0,0 +1,151 @@
+"""
+Deadline-aware poll cycles for /tasks/update-playing.
+
+A cycle is one sweep over every sharing user, in ActiveShare.id order. Each
+invocation locks the current cycle, polls chunks of users for as long as
+its time budget allows and saves the cursor after every chunk. The next
+invocation (the continuation request or, if that is lost, the next cron
+run) resumes from the cursor, so a cycle never loses its tail.
+"""
+import os
+import time
+import uuid
+import datetime
+from dataclasses import dataclass
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud_async
+import metrics
+import poller
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Seconds of polling per invocation. Keep it a few seconds under the
+# function's maximum duration (10s by default on Vercel Hobby).
+POLL_TIME_BUDGET = float(os.getenv("POLL_TIME_BUDGET", "8"))
+# Most users fetched and polled per chunk; fewer when less time is left.
+POLL_CHUNK_SIZE = int(os.getenv("POLL_CHUNK_SIZE", "100"))
+# A cycle lock outlives the budget by this long, so an invocation that was
+# killed mid-chunk blocks the cycle only briefly.
+POLL_CYCLE_LOCK_GRACE = float(os.getenv("POLL_CYCLE_LOCK_GRACE", "20"))
+# A chunk is only started when its estimated wall time, times this factor, fits in the time left.
+POLL_DEADLINE_SAFETY = 1.5
+# Weight of the newest chunk in the seconds-per-user moving average.
+SECONDS_PER_USER_ALPHA = 0.3
+
+@dataclass
+class SliceResult:
+    """What one invocation did to its cycle."""
+    cycle_id: int | None
+    cursor: int = 0
+    polled: int = 0
+    chunks: int = 0
+    finished: bool = False
+    busy: bool = False  # another invocation holds the cycle
+    circuit_open: bool = False
+
+    @property
+    def should_continue(self):
+        """True when the cycle has users left and nothing stands in the way of the next invocation."""
+        return self.cycle_id is not None and not (self.finished or self.busy or self.circuit_open)
+
+def chunk_limit(remaining: float, seconds_per_user: float | None, chunk_size: int):
+    """Users that fit in `remaining` seconds, at most `chunk_size`; 0 when none do."""
+    if remaining <= 0:
+        return 0
+    if not seconds_per_user:
+        return chunk_size
+    return min(chunk_size, int(remaining / (seconds_per_user * POLL_DEADLINE_SAFETY)))
+
+async def run_slice(
+    db: AsyncSession,
+    budget: float = POLL_TIME_BUDGET,
+    chunk_size: int = POLL_CHUNK_SIZE,
+    concurrency: int = poller.POLL_CONCURRENCY,
+    started: float | None = None,
+    resume_cycle: int | None = None,
+):
+    """
+    Polls the current cycle until it is finished or `budget` seconds after
+    `started` (a `time.monotonic()` value, the request's start by default)
+    are used up. A new cycle is started when the last one is finished,
+    unless `resume_cycle` is given: continuation requests only resume the
+    cycle they were sent for.
+    """
+    started = time.monotonic() if started is None else started
+    deadline = started + budget
+    owner = uuid.uuid4().hex
+    now = datetime.datetime.utcnow()
+    locked_until = now + datetime.timedelta(seconds=budget + POLL_CYCLE_LOCK_GRACE)
+    lock_expires = time.monotonic() + budget + POLL_CYCLE_LOCK_GRACE
+
+    cycle = await crud_async.get_latest_poll_cycle(db)
+    # Carried over from the previous cycle too, so the first chunk is sized right.
+    seconds_per_user = cycle.seconds_per_user if cycle is not None else None
+    if cycle is None or cycle.finished_at is not None:
+        if resume_cycle is not None:
+            return SliceResult(cycle_id=None, finished=True)
+        cycle_id = 1 if cycle is None else cycle.id + 1
+        if not await crud_async.start_poll_cycle(db, cycle_id, owner, now, locked_until):
+            return SliceResult(cycle_id=cycle_id, busy=True)
+        cursor = 0
+    else:
+        cycle_id = cycle.id
+        if resume_cycle is not None and resume_cycle != cycle_id:
+            return SliceResult(cycle_id=None, finished=True)
+        # The cursor is read as the cycle is locked, so a checkpoint saved
+        # just before is not polled again.
+        cycle = await crud_async.try_lock_poll_cycle(db, cycle_id, owner, now, locked_until)
+        if cycle is None:
+            return SliceResult(cycle_id=cycle_id, busy=True)
+        cursor = cycle.cursor
+
+    def still_owner():
+        return time.monotonic() < lock_expires
+
+    result = SliceResult(cycle_id=cycle_id, cursor=cursor)
+    while True:
+        remaining = deadline - time.monotonic()
+        limit = chunk_limit(remaining, seconds_per_user, chunk_size)
+        if limit <= 0 and result.chunks == 0 and remaining > 0:
+            # Every invocation makes progress, even when one user barely fits the budget.
+            limit = 1
+        if limit <= 0:
+            break
+        batch = await crud_async.get_poll_batch(db, after_id=result.cursor, limit=limit)
+        if not batch:
+            result.finished = await crud_async.checkpoint_poll_cycle(
+                db, cycle_id, owner, result.cursor, 0, None, datetime.datetime.utcnow(), finished=True,
+            )
+            return result
+
+        chunk_started = time.perf_counter()
+        outcome = await poller.run_batch(db, batch, concurrency=concurrency, still_owner=still_owner)
+        if outcome.circuit_open:
+            result.circuit_open = True
+            break
+        elapsed = time.perf_counter() - chunk_started
+        metrics.POLL_BATCH_SECONDS.observe(elapsed)
+
+        per_user = elapsed / len(batch)
+        seconds_per_user = per_user if seconds_per_user is None else (
+            SECONDS_PER_USER_ALPHA * per_user + (1 - SECONDS_PER_USER_ALPHA) * seconds_per_user
+        )
+        done = len(batch) < limit
+        if not await crud_async.checkpoint_poll_cycle(
+            db, cycle_id, owner, batch[-1].share_id, outcome.polled, seconds_per_user,
+            datetime.datetime.utcnow(), finished=done,
+        ):
+            # The lock ran out and another invocation took the cycle over.
+            result.busy = True
+            return result
+        result.cursor = batch[-1].share_id
+        result.polled += outcome.polled
+        result.chunks += 1
+        if done:
+            result.finished = True
+            return result
+
+    # Out of time: unlock, so the continuation can pick the cycle up at once.
+    await crud_async.unlock_poll_cycle(db, cycle_id, owner)
+    return result
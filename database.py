@@ -1,6 +1,10 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import asyncio
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -12,20 +16,161 @@ Base = declarative_base()
 # Database URL is taken from the environment variable 'DATABASE_URL'
 # This is for connecting to a production database like PostgreSQL on Vercel.
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Optional read replica; read-only queries go here when it is set.
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
 
-# If DATABASE_URL is not set, we fall back to a local SQLite database.
-# This is useful for local development and testing.
-if DATABASE_URL:
-    engine = create_engine(DATABASE_URL)
-else:
-    print("DATABASE_URL not found, falling back to SQLite for local development.")
-    SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
-    # `connect_args` is needed only for SQLite to allow multi-threaded access.
-    engine = create_engine(
-        SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-    )
+# Engine profile for non-SQLite databases:
+#   "serverless" - no client-side pool (NullPool); connections are pooled by
+#                  PgBouncer or the provider's pooler, so a frozen instance
+#                  holds no idle connections.
+#   "server"     - a sized pool with pre-ping and recycling for long-running processes.
+# Defaults to "serverless" on Vercel/AWS Lambda and "server" elsewhere.
+IS_SERVERLESS = bool(os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+DATABASE_PROFILE = os.getenv("DATABASE_PROFILE", "serverless" if IS_SERVERLESS else "server")
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Create tables and run migrations when the app starts. Off by default on
+# serverless, where it would add DB round trips to every cold start; run
+# `python migrations.py` once per deploy instead.
+AUTO_CREATE_SCHEMA = os.getenv("AUTO_CREATE_SCHEMA", "false" if IS_SERVERLESS else "true").lower() in ("1", "true", "yes")
+
+# "server" profile pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds
+
+# SQLite: how long a writer waits for the lock before failing, in milliseconds
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run while the poller writes; synchronous=NORMAL is
+    # durable across application crashes and only fsyncs at checkpoints.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+def _pool_options(profile: str):
+    if profile == "serverless":
+        return {"poolclass": NullPool}
+    if profile == "server":
+        return {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": True,
+        }
+    raise ValueError(f"Unknown DATABASE_PROFILE: {profile!r} (expected 'serverless' or 'server')")
+
+def make_engine(url: str, profile: str = DATABASE_PROFILE):
+    """Creates an engine for `url` with the connection settings of `profile`."""
+    if make_url(url).get_backend_name() == "sqlite":
+        # `connect_args` is needed only for SQLite to allow multi-threaded access.
+        sqlite_engine = create_engine(url, connect_args={"check_same_thread": False})
+        event.listen(sqlite_engine, "connect", _set_sqlite_pragmas)
+        return sqlite_engine
+    return create_engine(url, **_pool_options(profile))
+
+def to_async_url(url: str):
+    """The URL of the async driver for `url`: asyncpg for Postgres, aiosqlite for SQLite."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    if backend in ("postgresql", "postgres"):
+        # asyncpg takes `ssl` where libpq URLs say `sslmode`.
+        query = dict(url.query)
+        if "sslmode" in query:
+            query["ssl"] = query.pop("sslmode")
+        return url.set(drivername="postgresql+asyncpg", query=query)
+    return url
+
+def make_async_engine(url: str, profile: str = DATABASE_PROFILE):
+    """Like `make_engine`, for the async driver of `url`."""
+    async_url = to_async_url(url)
+    if async_url.get_backend_name() == "sqlite":
+        sqlite_engine = create_async_engine(async_url)
+        event.listen(sqlite_engine.sync_engine, "connect", _set_sqlite_pragmas)
+        return sqlite_engine
+    options = _pool_options(profile)
+    if profile == "serverless" and async_url.drivername == "postgresql+asyncpg":
+        # PgBouncer in transaction mode can't keep asyncpg's prepared statements.
+        options["connect_args"] = {"statement_cache_size": 0}
+    return create_async_engine(async_url, **options)
+
+# Engines are created on first use, so a cold start that serves no DB route
+# never loads a DB driver or opens a connection.
+_engine = None
+_read_engine = None
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        # If DATABASE_URL is not set, we fall back to a local SQLite database.
+        # This is useful for local development and testing.
+        if DATABASE_URL:
+            _engine = make_engine(DATABASE_URL)
+        else:
+            print("DATABASE_URL not found, falling back to SQLite for local development.")
+            _engine = make_engine("sqlite:///./sql_app.db")
+    return _engine
+
+def get_read_engine():
+    """The replica engine when DATABASE_READ_URL is set, otherwise the primary."""
+    global _read_engine
+    if _read_engine is None:
+        _read_engine = make_engine(DATABASE_READ_URL) if DATABASE_READ_URL else get_engine()
+    return _read_engine
+
+# Async engines are used by the async endpoints, the poller and worker.py.
+# Their connections belong to the event loop that opened them, so each loop
+# (one per asyncio.run, e.g. in benchmarks) gets engines of its own.
+_async_engines: dict[str, tuple] = {}
+
+def _get_async_engine(name: str, url: str):
+    loop = asyncio.get_running_loop()
+    engine, engine_loop = _async_engines.get(name, (None, None))
+    if engine is None or engine_loop is not loop:
+        if engine is not None:
+            engine.sync_engine.dispose(close=False)
+        engine = make_async_engine(url)
+        _async_engines[name] = (engine, loop)
+    return engine
+
+def get_async_engine():
+    return _get_async_engine("write", DATABASE_URL or "sqlite:///./sql_app.db")
+
+def get_async_read_engine():
+    """The async replica engine when DATABASE_READ_URL is set, otherwise the primary."""
+    return _get_async_engine("read", DATABASE_READ_URL) if DATABASE_READ_URL else get_async_engine()
+
+class _WriteSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        return get_engine()
+
+class _ReadSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        return get_read_engine()
+
+# Writes (and reads that must see them) use SessionLocal; read-only endpoints
+# use ReadSessionLocal, which points at the replica when one is configured.
+SessionLocal = sessionmaker(class_=_WriteSession, autocommit=False, autoflush=False)
+ReadSessionLocal = sessionmaker(class_=_ReadSession, autocommit=False, autoflush=False)
+
+class _AsyncWriteSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        return get_async_engine().sync_engine
+
+class _AsyncReadSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        return get_async_read_engine().sync_engine
+
+# Async counterparts for code running on the event loop. Objects stay loaded
+# after a commit, since reloading an attribute would need an await.
+AsyncSessionLocal = async_sessionmaker(sync_session_class=_AsyncWriteSession, autoflush=False, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(sync_session_class=_AsyncReadSession, autoflush=False, expire_on_commit=False)
 
 def get_db():
     """
@@ -38,12 +183,34 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    """Like `get_db`, but for read-only requests; may be served by the replica."""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_db():
+    """Like `get_db`, with an `AsyncSession` for async endpoints."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def get_async_read_db():
+    """Like `get_read_db`, with an `AsyncSession`."""
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
 def create_db_and_tables():
     """
-    Creates all database tables based on the models.
-    This should be called on application startup.
+    Creates all database tables based on the models and applies the
+    migrations. Run once per deploy with `python migrations.py`; the app
+    only runs it on startup when AUTO_CREATE_SCHEMA is on.
     """
     # Import all models here before calling create_all
     # to ensure they are registered with the Base metadata
     import models
+    import migrations
+    engine = get_engine()
     Base.metadata.create_all(bind=engine)
+    migrations.run_migrations(engine)
@@ -0,0 +1,67 @@
+"""
+The stored now-playing state as readers see it: serialized response bodies
+in the shared cache, and change notifications on the pub/sub hub.
+
+The poller publishes every committed track change here, whichever process
+runs it (a /tasks/update-playing invocation or worker.py), so the read
+endpoints of every instance serve it without a DB read.
+"""
+import os
+import crud_async
+import metrics
+import nowplaying
+from cache import CACHE_URL, SWRCache, make_backend, make_etag
+from database import AsyncReadSessionLocal
+from pubsub import hub
+from dotenv import load_dotenv
+
+load_dotenv()
+
+NOW_PLAYING_CACHE_TTL = float(os.getenv("NOW_PLAYING_CACHE_TTL", "15"))
+# After the TTL an entry is served for this much longer while one request reloads it.
+NOW_PLAYING_STALE_TTL = float(os.getenv("NOW_PLAYING_STALE_TTL", "30"))
+NOW_PLAYING_CACHE_SIZE = int(os.getenv("NOW_PLAYING_CACHE_SIZE", "10000"))
+
+# Serialized response bodies by Spotify id, in the CACHE_URL backend so all
+# instances share them. Concurrent misses share one DB read.
+now_playing_cache = SWRCache(
+    ttl=NOW_PLAYING_CACHE_TTL, stale_ttl=NOW_PLAYING_STALE_TTL,
+    backend=make_backend(CACHE_URL, namespace="now-playing:v2:spotify:", maxsize=NOW_PLAYING_CACHE_SIZE),
+)
+metrics.register_cache("spotify_now_playing", now_playing_cache)
+
+def serialize(track: dict):
+    """Serializes stored track fields into a `(body, etag)` pair."""
+    body = nowplaying.to_response(track).model_dump_json().encode()
+    return body, make_etag(body)
+
+async def _load(spotify_id: str):
+    """Reads the stored track of a user and serializes it; raises LookupError for unknown users."""
+    async with AsyncReadSessionLocal() as db:
+        row = await crud_async.get_user_and_track_by_spotify_id(db, spotify_id)
+    if row is None:
+        raise LookupError(spotify_id)
+
+    _, track = row
+    if track is None:
+        return serialize(nowplaying.NOT_PLAYING)[0]
+    return serialize({field: getattr(track, field) for field in nowplaying.NOT_PLAYING})[0]
+
+async def get(spotify_id: str):
+    """Returns the cached `(body, etag)` of a user, loading it on a miss; None for unknown users."""
+    try:
+        body = await now_playing_cache.get(spotify_id, lambda: _load(spotify_id))
+    except LookupError:
+        return None
+    return body, make_etag(body)
+
+async def publish(changed: list[dict], spotify_ids: dict[int, str]):
+    """Writes committed track rows through to the cache and notifies this process's subscribers."""
+    if not changed:
+        return
+    serialized = {spotify_ids[row["user_id"]]: serialize(row) for row in changed}
+    # One batched write, so readers on every instance see the change without a DB read.
+    await now_playing_cache.set_many({spotify_id: body for spotify_id, (body, _) in serialized.items()})
+    for spotify_id, message in serialized.items():
+        if hub.has_subscribers(spotify_id):
+            hub.publish(spotify_id, message)
@@ -1,7 +1,7 @@
 import os
 import sys
 from urllib.parse import urlparse, parse_qs
-import requests
+import httpx
 from dotenv import load_dotenv
 
 # Add project root to path to allow imports from other files
@@ -76,7 +76,7 @@ def main():
         print(f"\nRefresh Token: {refresh_token}\n")
         print("=" * 60)
 
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         print(f"\nError: An error occurred while fetching tokens from Spotify (HTTP {e.response.status_code}).")
         print("Response from Spotify:", e.response.json())
         print("\nPlease ensure your SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET in the .env file are correct.")
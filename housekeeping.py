@@ -0,0 +1,43 @@
+"""
+Periodic cleanup run by the /tasks/sweep-shares and /tasks/prune-history
+cron endpoints, or by worker.py. Each function takes a sync session; run
+it with `AsyncSession.run_sync` from async code.
+"""
+import os
+import datetime
+from sqlalchemy.orm import Session
+import crud
+import metrics
+import poller
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Days of raw play history kept by `prune_history`; daily rollups are kept forever.
+PLAY_HISTORY_DAYS = int(os.getenv("PLAY_HISTORY_DAYS", "30"))
+
+def sweep_shares(db: Session, limit: int = 1000):
+    """
+    Deletes shares past their `expires_at` in bulk, `limit` per transaction,
+    so the poll working set only holds users who are still sharing. Returns
+    how many were deleted.
+    """
+    now = datetime.datetime.utcnow()
+    swept = 0
+    while True:
+        user_ids = crud.delete_expired_shares(db, now, limit=limit)
+        with metrics.DB_OPERATION_SECONDS.time(operation="commit_sweep_shares"):
+            db.commit()
+        for user_id in user_ids:
+            poller.forget_user(user_id)
+        swept += len(user_ids)
+        if len(user_ids) < limit:
+            return swept
+
+def prune_history(db: Session, days: int = PLAY_HISTORY_DAYS):
+    """Deletes raw plays older than `days` days and returns `(deleted, before)`."""
+    before = datetime.datetime.utcnow().date() - datetime.timedelta(days=days)
+    deleted = crud.prune_plays(db, before)
+    with metrics.DB_OPERATION_SECONDS.time(operation="commit_prune_history"):
+        db.commit()
+    return deleted, before
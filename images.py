@@ -0,0 +1,204 @@
+import os
+import importlib.util
+import io
+import time
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlencode, urlsplit
+from fastapi import APIRouter, HTTPException, Query, Response
+from starlette.concurrency import run_in_threadpool
+import metrics
+from asyncutil import LoopLocal, SingleFlight
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Resizing needs the optional Pillow package; without it covers are cached
+# and served at their original size. It is imported on the first resize.
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+# Only covers from these hosts are proxied (Spotify and Last.fm image CDNs).
+IMAGE_ALLOWED_HOSTS = set(os.getenv(
+    "IMAGE_ALLOWED_HOSTS", "i.scdn.co,mosaic.scdn.co,lastfm.freetls.fastly.net,lastfm-img2.akamaized.net",
+).split(","))
+# Square sizes (px) that may be requested; the widget shows a 72px cover.
+IMAGE_SIZES = tuple(int(size) for size in os.getenv("IMAGE_SIZES", "64,160,300,640").split(","))
+IMAGE_DEFAULT_SIZE = int(os.getenv("IMAGE_DEFAULT_SIZE", "160"))
+# Prefix for proxied URLs in API responses, e.g. https://example.vercel.app; relative by default.
+IMAGE_PROXY_BASE_URL = os.getenv("IMAGE_PROXY_BASE_URL", "").rstrip("/")
+# On-disk cache; /tmp is the only writable directory on serverless hosts.
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "now-playing-images"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+# Covers larger than this are refused instead of downloaded.
+IMAGE_MAX_SOURCE_BYTES = int(os.getenv("IMAGE_MAX_SOURCE_BYTES", str(5 * 1024 * 1024)))
+
+# Spotify and Last.fm put a content hash in every image URL, so a source URL
+# always names the same bytes and the proxied response can be cached forever.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class DiskCache:
+    """
+    Stores files in one directory and evicts the least recently used once
+    their total size exceeds `max_bytes`. A file's mtime is its last use.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total: int | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # Write then rename, so readers never see a partial file.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._total is None:
+                self._total = self._scan()[1]
+            else:
+                self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        entries, total = [], 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        return entries, total
+
+    def _evict(self):
+        # Rescan so files written by other processes are counted too.
+        entries, self._total = self._scan()
+        entries.sort()
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self._total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._total -= size
+
+disk_cache = DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+metrics.register_cache("album_art", disk_cache)
+
+# --- Proxied URLs ---
+
+def is_allowed(url: str | None):
+    if not url:
+        return False
+    parts = urlsplit(url)
+    return parts.scheme == "https" and parts.hostname in IMAGE_ALLOWED_HOSTS
+
+def proxied_url(url: str | None, size: int = IMAGE_DEFAULT_SIZE):
+    """The proxy URL serving `url` resized to `size`; other URLs are returned unchanged."""
+    if not is_allowed(url):
+        return url
+    return f"{IMAGE_PROXY_BASE_URL}/api/images/{size}?{urlencode({'url': url})}"
+
+# --- Fetching and resizing ---
+
+def _make_client():
+    # httpx is imported with the first download, so other cold starts skip it.
+    import httpx
+    return httpx.AsyncClient(timeout=httpx.Timeout(10, connect=3), follow_redirects=False)
+
+_client = LoopLocal(_make_client)
+_downloads = SingleFlight()
+
+def cache_key(url: str, size: int):
+    return f"{hashlib.blake2b(url.encode(), digest_size=16).hexdigest()}-{size}"
+
+def resize(data: bytes, size: int):
+    """Shrinks an image to fit in `size`x`size` as JPEG; returns `data` unchanged without Pillow."""
+    if not PILLOW_AVAILABLE:
+        return data
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= size:
+            return data
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=85, optimize=True)
+        return output.getvalue()
+
+async def _download(url: str):
+    started, status = time.perf_counter(), "error"
+    try:
+        async with _client.get().stream("GET", url) as response:
+            status = response.status_code
+            response.raise_for_status()
+            if not response.headers.get("content-type", "").startswith("image/"):
+                raise ValueError("Not an image")
+            chunks, received = [], 0
+            async for chunk in response.aiter_bytes():
+                received += len(chunk)
+                if received > IMAGE_MAX_SOURCE_BYTES:
+                    raise ValueError("Image too large")
+                chunks.append(chunk)
+            return b"".join(chunks)
+    finally:
+        metrics.IMAGE_FETCH_SECONDS.observe(time.perf_counter() - started, status=status)
+
+async def _fetch_and_store(url: str, size: int, key: str):
+    data = await run_in_threadpool(resize, await _download(url), size)
+    await run_in_threadpool(disk_cache.set, key, data)
+    return data
+
+async def get_image(url: str, size: int):
+    """Returns the cover at `url` resized to `size`, downloading it once per size across concurrent requests."""
+    key = cache_key(url, size)
+    data = await run_in_threadpool(disk_cache.get, key)
+    if data is not None:
+        return data
+    return await _downloads.do(key, lambda: _fetch_and_store(url, size, key))
+
+def _media_type(data: bytes):
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+# --- Endpoint ---
+
+router = APIRouter()
+
+@router.get("/api/images/{size}", summary="Resized, cached album cover")
+async def image_proxy(size: int, url: str = Query(...)):
+    if size not in IMAGE_SIZES:
+        raise HTTPException(status_code=400, detail=f"Size must be one of {', '.join(map(str, IMAGE_SIZES))}.")
+    if not is_allowed(url):
+        raise HTTPException(status_code=400, detail="Image host not allowed.")
+    try:
+        data = await get_image(url, size)
+    except Exception as e:
+        metrics.record_error("image_proxy", e)
+        raise HTTPException(status_code=502, detail="Could not fetch image.")
+    return Response(content=data, media_type=_media_type(data), headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL})
@@ -0,0 +1,98 @@
+import os
+import importlib.util
+import time
+import metrics
+import asyncio
+from asyncutil import LoopLocal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# HTTP/2 needs the optional `h2` package (installed with `httpx[http2]`).
+# Only look it up here; httpx imports it when the first client is created.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+LASTFM_API_KEY = os.getenv("LASTFM_API_KEY")
+# Overridable so benchmarks can point at a local stand-in
+LASTFM_API_BASE_URL = os.getenv("LASTFM_API_BASE_URL", "https://ws.audioscrobbler.com/2.0/")
+
+# Connection settings shared by every request to Last.fm
+LASTFM_CONNECT_TIMEOUT = float(os.getenv("LASTFM_CONNECT_TIMEOUT", "3"))
+LASTFM_READ_TIMEOUT = float(os.getenv("LASTFM_READ_TIMEOUT", "10"))
+LASTFM_MAX_CONNECTIONS = int(os.getenv("LASTFM_MAX_CONNECTIONS", "50"))
+
+class LastfmClient:
+    """
+    A long-lived async Last.fm client with a pooled keep-alive connection,
+    so a slow Last.fm response only delays the requests waiting for it.
+    httpx is imported when the connection pool is first needed.
+    """
+
+    def __init__(
+        self,
+        api_key: str | None = LASTFM_API_KEY,
+        connect_timeout: float = LASTFM_CONNECT_TIMEOUT,
+        read_timeout: float = LASTFM_READ_TIMEOUT,
+        max_connections: int = LASTFM_MAX_CONNECTIONS,
+        http2: bool = HTTP2_AVAILABLE,
+    ):
+        self.api_key = api_key
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._max_connections = max_connections
+        self._http2 = http2
+        self._async_client = LoopLocal(self._make_async_client)
+
+    def _make_async_client(self):
+        import httpx
+        return httpx.AsyncClient(
+            http2=self._http2,
+            timeout=httpx.Timeout(self._read_timeout, connect=self._connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self._max_connections,
+                max_keepalive_connections=self._max_connections,
+                keepalive_expiry=60,
+            ),
+        )
+
+    @property
+    def async_client(self):
+        return self._async_client.get()
+
+    async def aclose(self):
+        client = self._async_client.pop()
+        if client is not None:
+            await client.aclose()
+
+    async def get_recent_tracks(self, username: str, limit: int = 1):
+        """Fetches the user's most recent scrobbles, including the one playing now."""
+        params = {
+            "method": "user.getrecenttracks",
+            "user": username,
+            "api_key": self.api_key,
+            "format": "json",
+            "limit": limit,
+        }
+        started, status = time.perf_counter(), "error"
+        try:
+            response = await self.async_client.get(LASTFM_API_BASE_URL, params=params)
+            status = response.status_code
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            metrics.LASTFM_REQUEST_SECONDS.observe(time.perf_counter() - started, method=params["method"], status=status)
+        response.raise_for_status()
+        return response.json()
+
+_client: LastfmClient | None = None
+
+def get_client():
+    """Returns the process-wide `LastfmClient`, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = LastfmClient()
+    return _client
+
+async def get_recent_tracks(username: str, limit: int = 1):
+    return await get_client().get_recent_tracks(username, limit)
@@ -1,33 +1,92 @@
 import os
+import re
+import hmac
 import time
+import base64
+import hashlib
+import asyncio
 import datetime
-import httpx
-from fastapi import FastAPI, Depends, HTTPException, Header, BackgroundTasks, Request
-from fastapi.responses import RedirectResponse, FileResponse
+from fastapi import FastAPI, Depends, HTTPException, Header, BackgroundTasks, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import RedirectResponse, FileResponse, StreamingResponse, PlainTextResponse
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import crud
 import models
+import metrics
+import feed
+import housekeeping
+import nowplaying
+import poller
+import cycles
+import resolver
+from ratelimit import spotify_breaker, spotify_limiter
 import spotify
-from database import create_db_and_tables, get_db
+import token_manager
+import images
+from cache import make_etag, etag_matches
+from pubsub import hub
+from database import AUTO_CREATE_SCHEMA, create_db_and_tables, get_db, get_read_db, get_async_db
 
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
 
 CRON_SECRET = os.getenv("CRON_SECRET")
+# Optional secret for /metrics, sent as the x-metrics-secret header
+METRICS_SECRET = os.getenv("METRICS_SECRET")
+
+# HTTP caching for /users/{spotify_id}/now-playing; the shared cache is configured in feed.py
+NOW_PLAYING_MAX_AGE = int(os.getenv("NOW_PLAYING_MAX_AGE", "15"))
+NOW_PLAYING_CACHE_CONTROL = f"public, max-age={NOW_PLAYING_MAX_AGE}, stale-while-revalidate={NOW_PLAYING_MAX_AGE * 2}"
+
+# Last.fm usernames accepted by /share/lastfm
+LASTFM_USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+# Signs the link tokens /auth/callback hands out for /share/lastfm; without
+# it no tokens are issued and linking is disabled. Tokens last LINK_TOKEN_TTL seconds.
+LINK_TOKEN_SECRET = os.getenv("LINK_TOKEN_SECRET")
+LINK_TOKEN_TTL = int(os.getenv("LINK_TOKEN_TTL", str(24 * 3600)))
+
+# Seconds between keep-alives on idle now-playing streams; each one also re-checks the shared cache
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", "15"))
 
 app = FastAPI()
+app.include_router(images.router)
 
 @app.on_event("startup")
 def on_startup():
     """
     This function runs when the application starts up.
-    It creates all the necessary database tables.
+    It creates all the necessary database tables unless that is done at deploy time.
     """
-    create_db_and_tables()
+    if AUTO_CREATE_SCHEMA:
+        create_db_and_tables()
 
 # --- Authentication Flow ---
 
+def _sign_link_payload(payload: str):
+    return hmac.new(LINK_TOKEN_SECRET.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+def make_link_token(spotify_id: str):
+    """A token proving its holder logged in as `spotify_id`, valid for LINK_TOKEN_TTL seconds."""
+    expires = int(time.time()) + LINK_TOKEN_TTL
+    payload = base64.urlsafe_b64encode(f"{spotify_id}:{expires}".encode()).decode().rstrip("=")
+    return f"{payload}.{_sign_link_payload(payload)}"
+
+def read_link_token(token: str):
+    """Returns the Spotify id a link token was issued to; None if it is forged, malformed or expired."""
+    if not LINK_TOKEN_SECRET:
+        return None
+    payload, _, signature = token.partition(".")
+    if not hmac.compare_digest(signature.encode(), _sign_link_payload(payload).encode()):
+        return None
+    try:
+        spotify_id, _, expires = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)).decode().rpartition(":")
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    return spotify_id
+
 @app.get("/auth/login", summary="Display login page")
 def login_page():
     """
@@ -44,7 +103,8 @@ def auth_spotify_redirect():
 def auth_callback(code: str, db: Session = Depends(get_db)):
     """
     Callback endpoint for Spotify's OAuth flow.
-    Exchanges the code for tokens and creates/updates the user.
+    Exchanges the code for tokens and creates/updates the user. The
+    response carries a `link_token` for /share/lastfm when LINK_TOKEN_SECRET is set.
     """
     try:
         token_data = spotify.get_token_data_from_code(code)
@@ -67,83 +127,294 @@ def auth_callback(code: str, db: Session = Depends(get_db)):
         refresh_token=token_data["refresh_token"],
         expires_at=token_data["expires_at"],
     )
-    return {"message": "Successfully authenticated. You can now close this page."}
+    token_manager.manager.put(user.id, token_data["access_token"], token_data["refresh_token"], token_data["expires_at"])
+    resolver.forget_link(user.spotify_id)
+    response = {"message": "Successfully authenticated. You can now close this page."}
+    if LINK_TOKEN_SECRET:
+        response["link_token"] = make_link_token(user.spotify_id)
+    return response
 
 # --- Background Task ---
 
 async def trigger_next_batch(url: str, headers: dict, params: dict):
-    """Asynchronously triggers the next batch of the cron job."""
+    """
+    Asynchronously triggers the next invocation of the cron job. If this
+    request is lost, the next cron run resumes the cycle instead.
+    """
+    # Imported here: no other main.py code path needs httpx at import time.
+    import httpx
     async with httpx.AsyncClient() as client:
         try:
             await client.post(url, headers=headers, params=params, timeout=5)
         except httpx.RequestError as e:
+            metrics.record_error("trigger_next_batch", e)
             print(f"Error triggering next batch: {e}")
 
 @app.post("/tasks/update-playing", summary="Update playing status for all users")
 async def update_playing_task(
     request: Request,
     background_tasks: BackgroundTasks,
+    x_cron_secret: str = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+    cycle: int | None = None,
+    budget: float = Query(cycles.POLL_TIME_BUDGET, gt=0),
+    chunk: int = Query(cycles.POLL_CHUNK_SIZE, ge=1),
+    concurrency: int = poller.POLL_CONCURRENCY,
+):
+    """
+    Polls as many users as fit in `budget` seconds, in chunks, saving the
+    cycle's cursor after each one. The cron job starts a cycle; while users
+    are left, each invocation triggers the next one to resume it, and if
+    that request is lost the next cron run resumes from the cursor.
+    """
+    started = time.monotonic()
+    if not CRON_SECRET or x_cron_secret != CRON_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized cron job.")
+
+    result = await cycles.run_slice(
+        db, budget=budget, chunk_size=chunk, concurrency=concurrency,
+        started=started, resume_cycle=cycle,
+    )
+    if result.should_continue:
+        next_url = str(request.url.remove_query_params(["cycle", "budget", "chunk", "concurrency"]))
+        headers = {'x-cron-secret': x_cron_secret}
+        params = {'cycle': result.cycle_id, 'budget': budget, 'chunk': chunk, 'concurrency': concurrency}
+        background_tasks.add_task(trigger_next_batch, next_url, headers, params)
+
+    if result.busy:
+        message = f"Cycle {result.cycle_id} is being polled by another invocation."
+    elif result.circuit_open:
+        # No continuation; the next cron run resumes the cycle once Spotify recovers.
+        message = f"Spotify circuit open; cycle {result.cycle_id} paused at share {result.cursor}."
+    elif result.cycle_id is None:
+        message = f"Cycle {cycle} is already finished."
+    else:
+        message = f"Polled {result.chunks} chunks of cycle {result.cycle_id}, up to share {result.cursor}."
+    return {
+        "message": message,
+        "cycle": result.cycle_id,
+        "cursor": result.cursor,
+        "chunks": result.chunks,
+        "polled": result.polled,
+        "finished": result.finished,
+        "rate_limit": spotify_limiter.stats(),
+        "circuit": spotify_breaker.stats(),
+    }
+
+@app.post("/tasks/refresh-tokens", summary="Refresh access tokens that are about to expire")
+async def refresh_tokens_task(
+    x_cron_secret: str = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+    limit: int = 500,
+):
+    """
+    Refreshes every sharing user's token that expires within the refresh
+    margin, so the poll loop never has to wait on the token endpoint.
+    """
+    if not CRON_SECRET or x_cron_secret != CRON_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized cron job.")
+
+    return await token_manager.manager.refresh_expiring(db, limit=limit)
+
+@app.post("/tasks/sweep-shares", summary="Delete expired shares")
+def sweep_shares_task(
     x_cron_secret: str = Header(None),
     db: Session = Depends(get_db),
-    offset: int = 0,
-    limit: int = 20
+    limit: int = 1000,
 ):
     """
-    A background task endpoint that processes users in batches to avoid serverless timeouts.
+    Deletes shares past their `expires_at` in bulk, `limit` per transaction,
+    so the poll working set only holds users who are still sharing.
     """
     if not CRON_SECRET or x_cron_secret != CRON_SECRET:
         raise HTTPException(status_code=401, detail="Unauthorized cron job.")
 
-    active_shares = db.query(models.ActiveShare).offset(offset).limit(limit).all()
-    if not active_shares:
-        return {"message": "No more active users to process."}
-
-    for share in active_shares:
-        user = share.user
-        token = crud.get_token_by_user_id(db, user.id)
-        if not token:
-            continue
-
-        if token.expires_at < datetime.datetime.utcnow():
-            try:
-                new_token_data = spotify.refresh_access_token(token.refresh_token)
-                crud.create_or_update_token(
-                    db, user.id, new_token_data["access_token"],
-                    new_token_data.get("refresh_token", token.refresh_token),
-                    new_token_data["expires_at"]
-                )
-                token.access_token = new_token_data["access_token"]
-            except Exception:
-                crud.stop_sharing(db, user.id)
-                continue
+    swept = housekeeping.sweep_shares(db, limit=limit)
+    return {"message": f"Deleted {swept} expired shares.", "deleted": swept}
+
+@app.post("/tasks/prune-history", summary="Delete old play history")
+def prune_history_task(
+    x_cron_secret: str = Header(None),
+    db: Session = Depends(get_db),
+    days: int = housekeeping.PLAY_HISTORY_DAYS,
+):
+    """Deletes raw plays older than `days` days. The daily rollups are not touched."""
+    if not CRON_SECRET or x_cron_secret != CRON_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized cron job.")
+
+    deleted, before = housekeeping.prune_history(db, days=days)
+    return {"message": f"Deleted {deleted} plays before {before}.", "deleted": deleted}
+
+# --- Now Playing ---
+
+@app.get("/users/{spotify_id}/now-playing", response_model=nowplaying.NowPlayingResponse, summary="Get a user's current track")
+async def user_now_playing(spotify_id: str, if_none_match: str | None = Header(None)):
+    """
+    Serves the last track stored by the poller from the shared cache.
+    Cache hits never touch the database, and a matching `If-None-Match`
+    gets a bodyless 304.
+    """
+    cached = await feed.get(spotify_id)
+    if cached is None:
+        raise HTTPException(status_code=404, detail="User not found.")
 
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": NOW_PLAYING_CACHE_CONTROL}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/users/{spotify_id}/now-playing/live", response_model=nowplaying.NowPlayingResponse, summary="Ask the user's providers what is playing now")
+async def user_now_playing_live(spotify_id: str, if_none_match: str | None = Header(None)):
+    """
+    Asks Spotify, and Last.fm for users who linked an account, directly
+    instead of serving the poller's last result. The slower provider is
+    hedged against the faster one (see resolver.py); the one that answered
+    is named in the `X-Now-Playing-Provider` header. Answers are shared for
+    NOW_PLAYING_LIVE_TTL seconds.
+    """
+    link = await resolver.get_link(spotify_id)
+    if link is None:
+        raise HTTPException(status_code=404, detail="User not found.")
+    if not link.providers():
+        raise HTTPException(status_code=409, detail="User has no linked now-playing provider.")
+    try:
+        body, provider = await resolver.lookup(link)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail="Could not reach any now-playing provider.") from e
+
+    etag = make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Now-Playing-Provider": provider}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def _sse_event(body: bytes, etag: str):
+    return f"event: now-playing\nid: {etag}\ndata: {body.decode()}\n\n"
+
+# Named, not a comment, so clients can tell a live but idle stream from a dead one.
+SSE_KEEPALIVE = "event: keep-alive\ndata: ping\n\n"
+
+async def _next_now_playing(spotify_id: str, queue: asyncio.Queue, etag: str):
+    """
+    Waits up to STREAM_KEEPALIVE seconds for the user's next state and
+    returns it as `(body, etag)`, or None when it is still `etag`.
+
+    The hub only carries changes polled by this process; the poller usually
+    runs elsewhere (another serverless invocation, worker.py), so every
+    quiet tick also re-reads the shared cache the poller writes through to.
+    """
+    try:
+        message = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE)
+    except asyncio.TimeoutError:
+        message = await feed.get(spotify_id)
+    if message is None or message[1] == etag:
+        return None
+    return message
+
+@app.get("/users/{spotify_id}/now-playing/stream", summary="Stream a user's track changes (SSE)")
+async def user_now_playing_stream(spotify_id: str):
+    """
+    A Server-Sent Events stream that sends the current track right away and
+    then every change: at once through the pub/sub hub when this process
+    polled it, otherwise from the shared cache within STREAM_KEEPALIVE seconds.
+    """
+    cached = await feed.get(spotify_id)
+    if cached is None:
+        raise HTTPException(status_code=404, detail="User not found.")
+    queue = hub.subscribe(spotify_id)
+
+    async def events():
+        body, etag = cached
         try:
-            currently_playing = spotify.get_currently_playing(token.access_token)
-            if currently_playing and currently_playing.get("is_playing"):
-                track_data = {
-                    "track_name": currently_playing["item"]["name"],
-                    "artist_name": ", ".join(artist["name"] for artist in currently_playing["item"]["artists"]),
-                    "album_cover_url": currently_playing["item"]["album"]["images"][0]["url"],
-                    "spotify_track_url": currently_playing["item"]["external_urls"]["spotify"],
-                    "currently_playing": True,
-                }
-            else:
-                track_data = { "track_name": "Not currently playing", "artist_name": "", "album_cover_url": "", "spotify_track_url": "", "currently_playing": False }
-            crud.create_or_update_track(db, user.id, track_data)
-        except Exception:
-            continue
-
-    if len(active_shares) == limit:
-        next_offset = offset + limit
-        next_url = str(request.url)
-        headers = {'x-cron-secret': x_cron_secret}
-        params = {'offset': next_offset, 'limit': limit}
-        background_tasks.add_task(trigger_next_batch, next_url, headers, params)
+            yield _sse_event(body, etag)
+            while True:
+                message = await _next_now_playing(spotify_id, queue, etag)
+                if message is None:
+                    yield SSE_KEEPALIVE
+                    continue
+                body, etag = message
+                yield _sse_event(body, etag)
+        finally:
+            hub.unsubscribe(spotify_id, queue)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+@app.websocket("/users/{spotify_id}/now-playing/ws")
+async def user_now_playing_ws(websocket: WebSocket, spotify_id: str):
+    """The same stream as the SSE endpoint, over a WebSocket (one JSON text message per change)."""
+    cached = await feed.get(spotify_id)
+    if cached is None:
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    queue = hub.subscribe(spotify_id)
+    # Clients do not send anything; this only notices when they go away.
+    receiver = asyncio.ensure_future(websocket.receive())
+    body, etag = cached
+    try:
+        await websocket.send_text(body.decode())
+        while True:
+            getter = asyncio.ensure_future(_next_now_playing(spotify_id, queue, etag))
+            done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                getter.cancel()
+                break
+            message = getter.result()
+            if message is not None:
+                body, etag = message
+                await websocket.send_text(body.decode())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        hub.unsubscribe(spotify_id, queue)
+
+# --- Listening Stats ---
+
+def _get_user_or_404(db: Session, spotify_id: str):
+    user = crud.get_user_by_spotify_id(db, spotify_id=spotify_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found.")
+    return user
+
+@app.get("/users/{spotify_id}/top-tracks", response_model=list[models.TopTrack], summary="Get a user's most played tracks")
+def user_top_tracks(
+    spotify_id: str,
+    days: int = Query(7, ge=1, le=365),
+    limit: int = Query(10, ge=1, le=50),
+    db: Session = Depends(get_read_db),
+):
+    """Most played tracks over the last `days` days (today included), from the daily rollups."""
+    user = _get_user_or_404(db, spotify_id)
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)
+    return [
+        models.TopTrack(track=row.track_name, artist=row.artist_name, spotify_track_id=row.spotify_track_id, plays=row.plays)
+        for row in crud.get_top_tracks(db, user.id, since, limit)
+    ]
 
-    return {"message": f"Processed batch of {len(active_shares)} users from offset {offset}."}
+@app.get("/users/{spotify_id}/top-artists", response_model=list[models.TopArtist], summary="Get a user's most played artists")
+def user_top_artists(
+    spotify_id: str,
+    days: int = Query(7, ge=1, le=365),
+    limit: int = Query(10, ge=1, le=50),
+    db: Session = Depends(get_read_db),
+):
+    """Most played artists over the last `days` days (today included), from the daily rollups."""
+    user = _get_user_or_404(db, spotify_id)
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)
+    return [models.TopArtist(artist=row.artist_name, plays=row.plays) for row in crud.get_top_artists(db, user.id, since, limit)]
 
 # --- Other Endpoints ---
 
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse)
+def get_metrics(x_metrics_secret: str = Header(None)):
+    if METRICS_SECRET and x_metrics_secret != METRICS_SECRET:
+        raise HTTPException(status_code=401, detail="Unauthorized.")
+    return PlainTextResponse(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/", summary="API Root")
 def read_root():
     return {"message": "Spotify Track Sharer API is running."}
@@ -156,10 +427,35 @@ def share_start(share_request: models.ShareRequest, db: Session = Depends(get_db
     crud.start_sharing(db=db, user_id=user.id)
     return {"message": "Sharing started successfully."}
 
+@app.post("/share/lastfm", status_code=200, summary="Link or unlink a Last.fm account")
+def share_lastfm(
+    link_request: models.LastfmLinkRequest,
+    authorization: str | None = Header(None),
+    db: Session = Depends(get_db),
+):
+    """
+    Links a Last.fm account to the user the bearer token was issued to: the
+    `link_token` from /auth/callback, sent as `Authorization: Bearer <token>`.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    spotify_id = read_link_token(token) if scheme.lower() == "bearer" else None
+    if spotify_id is None:
+        raise HTTPException(status_code=401, detail="Missing or invalid link token.", headers={"WWW-Authenticate": "Bearer"})
+    username = link_request.lastfm_username
+    if username is not None and not LASTFM_USERNAME_PATTERN.match(username):
+        raise HTTPException(status_code=400, detail="Invalid Last.fm username.")
+    user = crud.get_user_by_spotify_id(db, spotify_id=spotify_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found.")
+    crud.set_lastfm_username(db=db, user_id=user.id, lastfm_username=username)
+    resolver.forget_link(user.spotify_id)
+    return {"message": "Last.fm account linked." if username else "Last.fm account unlinked."}
+
 @app.post("/share/stop", status_code=200, summary="Stop sharing playing status")
 def share_stop(share_request: models.ShareRequest, db: Session = Depends(get_db)):
     user = crud.get_user_by_spotify_id(db, spotify_id=share_request.spotify_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found.")
     crud.stop_sharing(db=db, user_id=user.id)
+    poller.forget_user(user.id)
     return {"message": "Sharing stopped successfully."}
@@ -0,0 +1,218 @@
+import time
+import bisect
+import threading
+import functools
+from contextlib import contextmanager
+
+# Prometheus metrics kept in process memory and rendered in the text
+# exposition format. Recording a value is a dict lookup and an addition
+# under a lock, so collection can stay on in production.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple, extra: str = ""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket..., +Inf count], sum
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the `with` block, even when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Callback(_Metric):
+    """A counter or gauge whose samples are read from `collect()` at scrape time: `{label values: value}`."""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...], collect, kind: str = "gauge"):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+        self.kind = kind
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self.collect().items()
+        ]
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, labelnames: tuple[str, ...], collect, kind: str = "gauge"):
+        return self.register(Callback(name, help, labelnames, collect, kind))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# --- Metrics ---
+
+SPOTIFY_REQUEST_SECONDS = registry.histogram(
+    "spotify_request_duration_seconds", "Latency of Spotify API calls.", ("endpoint", "status"))
+LASTFM_REQUEST_SECONDS = registry.histogram(
+    "lastfm_request_duration_seconds", "Latency of Last.fm API calls.", ("method", "status"))
+DB_OPERATION_SECONDS = registry.histogram(
+    "db_operation_duration_seconds", "Latency of DB queries and commits, by crud function.", ("operation",))
+POLL_BATCH_SECONDS = registry.histogram(
+    "poll_batch_duration_seconds", "Wall time of one /tasks/update-playing batch.")
+POLL_BATCH_USERS = registry.histogram(
+    "poll_batch_users", "Users per poll batch.", ("stage",), buckets=SIZE_BUCKETS)
+IMAGE_FETCH_SECONDS = registry.histogram(
+    "image_fetch_duration_seconds", "Latency of album cover downloads by the image proxy.", ("status",))
+NOW_PLAYING_PROVIDER_SECONDS = registry.histogram(
+    "now_playing_provider_duration_seconds", "Latency of live now-playing lookups by provider and outcome.", ("provider", "outcome"))
+NOW_PLAYING_RESOLVES = registry.counter(
+    "now_playing_resolves_total", "Live now-playing lookups by winning provider and whether a hedge was sent.", ("provider", "hedged"))
+TOKEN_REFRESHES = registry.counter(
+    "token_refreshes_total", "Access token refreshes by outcome.", ("result",))
+ERRORS = registry.counter(
+    "errors_total", "Errors by component and cause.", ("component", "cause"))
+
+_caches: dict[str, object] = {}
+
+def register_cache(name: str, cache):
+    """Exports the hit/miss counters of a `cache.TTLCache`, `cache.SWRCache`, cache backend or `images.DiskCache` under `name`."""
+    _caches[name] = cache
+
+def _cache_requests():
+    values = {}
+    for name, cache in _caches.items():
+        values[(name, "hit")] = cache.hits
+        values[(name, "miss")] = cache.misses
+        if hasattr(cache, "stale_hits"):
+            values[(name, "stale")] = cache.stale_hits
+    return values
+
+def _cache_hit_ratio():
+    values = {}
+    for name, cache in _caches.items():
+        hits = cache.hits + getattr(cache, "stale_hits", 0)
+        total = hits + cache.misses
+        values[(name,)] = hits / total if total else 0
+    return values
+
+registry.callback(
+    "cache_requests_total", "Cache lookups by result.", ("cache", "result"), _cache_requests, kind="counter")
+registry.callback(
+    "cache_hit_ratio", "Share of cache lookups served from the cache.", ("cache",), _cache_hit_ratio)
+
+# --- Helpers ---
+
+def error_cause(exc: BaseException):
+    """A short, low-cardinality label for an exception."""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return f"http_{status}"
+    return type(exc).__name__
+
+def record_error(component: str, exc: BaseException):
+    ERRORS.inc(component=component, cause=error_cause(exc))
+
+def timed_db(func):
+    """Decorator recording a crud function's latency under its own name."""
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with DB_OPERATION_SECONDS.time(operation=operation):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,80 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from database import Base
+
+# `create_all()` only creates missing tables; it never alters existing ones.
+# Everything below brings a database created by an older version of the
+# models up to date and is safe to run on every startup.
+
+# (index name, table, column) for the one-row-per-user tables that the
+# bulk upserts in crud.py rely on for `ON CONFLICT (user_id)`.
+UNIQUE_USER_INDEXES = [
+    ("ix_tokens_user_id", "tokens", "user_id"),
+    ("ix_tracks_user_id", "tracks", "user_id"),
+]
+
+# (index name, table, column) for plain indexes on filter columns.
+INDEXES = [
+    ("ix_active_shares_expires_at", "active_shares", "expires_at"),
+]
+
+# (table, column) pairs added to existing tables after their first release.
+# The column type and server default are taken from the model definition.
+ADDED_COLUMNS = [
+    ("tracks", "spotify_track_id"),
+    ("tracks", "updated_at"),
+    ("active_shares", "consecutive_errors"),
+    ("active_shares", "last_error"),
+    ("active_shares", "next_eligible_at"),
+    ("active_shares", "next_poll_at"),
+    ("active_shares", "idle_streak"),
+    ("users", "lastfm_username"),
+]
+
+def _ensure_columns(conn):
+    inspector = inspect(conn)
+    for table, column in ADDED_COLUMNS:
+        existing = {col["name"] for col in inspector.get_columns(table)}
+        if column in existing:
+            continue
+        model_column = Base.metadata.tables[table].c[column]
+        ddl = f"ALTER TABLE {table} ADD COLUMN {column} {model_column.type.compile(dialect=conn.dialect)}"
+        if model_column.server_default is not None:
+            # Existing rows get the default, so the column can be NOT NULL right away.
+            ddl += f" DEFAULT {model_column.server_default.arg}"
+            if not model_column.nullable:
+                ddl += " NOT NULL"
+        conn.execute(text(ddl))
+
+def _index_names(inspector, table: str):
+    return {index["name"] for index in inspector.get_indexes(table)}
+
+def _ensure_unique_indexes(conn):
+    inspector = inspect(conn)
+    for name, table, column in UNIQUE_USER_INDEXES:
+        if name in _index_names(inspector, table):
+            continue
+        # Keep only the newest row per user so the unique index can be built.
+        conn.execute(text(
+            f"DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY {column})"
+        ))
+        conn.execute(text(f"CREATE UNIQUE INDEX {name} ON {table} ({column})"))
+
+def _ensure_indexes(conn):
+    inspector = inspect(conn)
+    for name, table, column in INDEXES:
+        if name not in _index_names(inspector, table):
+            conn.execute(text(f"CREATE INDEX {name} ON {table} ({column})"))
+
+def run_migrations(engine: Engine):
+    """Applies all idempotent schema upgrades in a single transaction."""
+    with engine.begin() as conn:
+        _ensure_columns(conn)
+        _ensure_unique_indexes(conn)
+        _ensure_indexes(conn)
+
+if __name__ == "__main__":
+    # One-time schema step for deploys: python migrations.py
+    import database
+    database.create_db_and_tables()
+    print("Database schema is up to date.")
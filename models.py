@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, Float, String, DateTime, Date, ForeignKey, Boolean, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database import Base
 import datetime
@@ -10,6 +10,8 @@ class User(Base):
     spotify_id = Column(String, unique=True, index=True, nullable=False)
     display_name = Column(String)
     profile_pic_url = Column(String, nullable=True)
+    # Optional Last.fm account; /users/{spotify_id}/now-playing/live asks both providers when it is set.
+    lastfm_username = Column(String, nullable=True)
 
     token = relationship("Token", back_populates="user", uselist=False)
     track = relationship("Track", back_populates="user", uselist=False)
@@ -18,7 +20,7 @@ class User(Base):
 class Token(Base):
     __tablename__ = "tokens"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, index=True, nullable=False)
     access_token = Column(String, nullable=False)
     refresh_token = Column(String, nullable=False)
     expires_at = Column(DateTime, nullable=False)
@@ -28,12 +30,17 @@ class Token(Base):
 class Track(Base):
     __tablename__ = "tracks"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, index=True, nullable=False)
     track_name = Column(String)
     artist_name = Column(String)
     album_cover_url = Column(String)
     spotify_track_url = Column(String)
     currently_playing = Column(Boolean, default=False)
+    # Spotify track id + currently_playing fingerprint the stored state; the
+    # poller only rewrites the row when they change, so updated_at is the
+    # time of the last real transition. A paused track keeps its id.
+    spotify_track_id = Column(String, nullable=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
 
     user = relationship("User", back_populates="track")
 
@@ -41,11 +48,114 @@ class ActiveShare(Base):
     __tablename__ = "active_shares"
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), unique=True, nullable=False)
-    expires_at = Column(DateTime, default=lambda: datetime.datetime.utcnow() + datetime.timedelta(hours=24))
+    expires_at = Column(DateTime, index=True, default=lambda: datetime.datetime.utcnow() + datetime.timedelta(hours=24))
+    # Poll failure backoff: the poller skips the share until next_eligible_at
+    # after consecutive_errors failed polls in a row. A new share starts clean.
+    consecutive_errors = Column(Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(String, nullable=True)
+    next_eligible_at = Column(DateTime, nullable=True)
+    # Adaptive poll schedule (see scheduler.py), kept here so it holds across
+    # serverless invocations and workers: the share is not polled before
+    # next_poll_at, and idle_streak counts polls in a row that found nothing playing.
+    next_poll_at = Column(DateTime, nullable=True)
+    idle_streak = Column(Integer, nullable=False, default=0, server_default="0")
 
     user = relationship("User", back_populates="active_share")
 
+# --- Listening history ---
+#
+# `plays` is append-only: one row per track transition seen by the poller,
+# pruned by age. The daily rollups are updated in the same transaction as
+# the plays they count and outlive them, so stats never scan `plays`.
+
+class Play(Base):
+    __tablename__ = "plays"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    spotify_track_id = Column(String, nullable=False)
+    track_name = Column(String)
+    artist_name = Column(String)
+    started_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_plays_user_id_started_at", "user_id", "started_at"),
+        Index("ix_plays_started_at", "started_at"),  # for pruning by day
+    )
+
+class DailyTrackPlays(Base):
+    __tablename__ = "daily_track_plays"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    spotify_track_id = Column(String, nullable=False)
+    track_name = Column(String)
+    artist_name = Column(String)
+    plays = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint("user_id", "day", "spotify_track_id", name="uq_daily_track_plays"),)
+
+class DailyArtistPlays(Base):
+    __tablename__ = "daily_artist_plays"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    artist_name = Column(String, nullable=False)
+    plays = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint("user_id", "day", "artist_name", name="uq_daily_artist_plays"),)
+
+# --- Poll workers ---
+#
+# Users are split into hash shards (user_id % POLL_SHARDS). A worker process
+# polls a shard only while it holds that shard's lease, and heartbeats in
+# `poll_workers` so the others know how many ways to split the shards.
+
+class ShardLease(Base):
+    __tablename__ = "shard_leases"
+    shard = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String, nullable=True)
+    expires_at = Column(DateTime, nullable=True)
+
+class PollWorker(Base):
+    __tablename__ = "poll_workers"
+    id = Column(String, primary_key=True)
+    heartbeat_at = Column(DateTime, nullable=False, index=True)
+
+# --- Poll cycles ---
+#
+# One row per sweep of /tasks/update-playing over all sharing users. `cursor`
+# is the last ActiveShare.id polled and is saved after every chunk, so an
+# invocation that dies or times out loses at most the chunk it was on; the
+# next invocation holding the lock resumes from the cursor.
+
+class PollCycle(Base):
+    __tablename__ = "poll_cycles"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    cursor = Column(Integer, nullable=False, default=0)
+    polled = Column(Integer, nullable=False, default=0)
+    invocations = Column(Integer, nullable=False, default=0)
+    # Moving average of chunk wall time per user, used to size chunks to the time left
+    seconds_per_user = Column(Float, nullable=True)
+    owner = Column(String, nullable=True)
+    locked_until = Column(DateTime, nullable=True)
+    started_at = Column(DateTime, nullable=False)
+    checkpointed_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
 # Pydantic models for request/response validation
 class ShareRequest(BaseModel):
     spotify_id: str
 
+class LastfmLinkRequest(BaseModel):
+    # The user comes from the link token; None unlinks the Last.fm account.
+    lastfm_username: str | None = None
+
+class TopTrack(BaseModel):
+    track: str | None
+    artist: str | None
+    spotify_track_id: str
+    plays: int
+
+class TopArtist(BaseModel):
+    artist: str
+    plays: int
@@ -0,0 +1,51 @@
+"""
+The now-playing response shared by every endpoint and the conversions into
+it, so a user looks the same whichever provider or endpoint answered.
+Free of database imports, so api/index.py can use it without loading them.
+"""
+import datetime
+from pydantic import BaseModel
+import images
+
+class NowPlayingResponse(BaseModel):
+    track: str
+    artist: str
+    album_cover: str | None
+    track_link: str | None
+    currently_playing: bool
+    updated_at: datetime.datetime | None = None
+
+# Stored-track fields (see models.Track) shown when nothing is playing.
+NOT_PLAYING = {
+    "track_name": "Not currently playing", "artist_name": "", "album_cover_url": "",
+    "spotify_track_url": "", "currently_playing": False, "updated_at": None,
+}
+
+def to_response(track: dict):
+    """A `NowPlayingResponse` from stored-track fields; covers are served through the image proxy."""
+    return NowPlayingResponse(
+        track=track["track_name"] or "",
+        artist=track["artist_name"] or "",
+        album_cover=images.proxied_url(track["album_cover_url"] or None),
+        track_link=track["spotify_track_url"] or None,
+        currently_playing=bool(track["currently_playing"]),
+        updated_at=track.get("updated_at"),
+    )
+
+def from_lastfm(data: dict):
+    """Converts a `user.getrecenttracks` response; raises ValueError for error payloads."""
+    if "recenttracks" not in data:
+        raise ValueError(f"Unexpected Last.fm response: {data.get('message', 'no recenttracks')}")
+    recent_tracks = data["recenttracks"].get("track", [])
+    latest_track = recent_tracks[0] if recent_tracks else {}
+    if latest_track.get("@attr", {}).get("nowplaying") != "true":
+        return to_response(NOT_PLAYING)
+    # Images are listed smallest first; use the largest one present.
+    cover = next((image.get("#text") for image in reversed(latest_track.get("image", [])) if image.get("#text")), None)
+    return to_response({
+        "track_name": latest_track.get("name"),
+        "artist_name": latest_track.get("artist", {}).get("#text"),
+        "album_cover_url": cover,
+        "spotify_track_url": latest_track.get("url"),
+        "currently_playing": True,
+    })
@@ -0,0 +1,293 @@
+import os
+import asyncio
+import datetime
+from collections import OrderedDict
+from dataclasses import dataclass
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud
+import feed
+import metrics
+import spotify
+import token_manager
+from ratelimit import RateLimited, spotify_breaker
+from scheduler import scheduler
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Maximum number of users polled against Spotify at the same time.
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "10"))
+# A user whose polls keep failing is skipped for BASE, 2*BASE, 4*BASE, ...
+# seconds after each consecutive failure, up to MAX.
+POLL_FAILURE_BACKOFF_BASE = float(os.getenv("POLL_FAILURE_BACKOFF_BASE", "60"))
+POLL_FAILURE_BACKOFF_MAX = float(os.getenv("POLL_FAILURE_BACKOFF_MAX", str(6 * 3600)))
+# Most users whose last track fingerprint is kept in memory. Every batch
+# re-reads its users' fingerprints from the stored tracks, so an evicted
+# one costs at most a redundant write.
+POLL_FINGERPRINT_CACHE_SIZE = int(os.getenv("POLL_FINGERPRINT_CACHE_SIZE", "100000"))
+
+# --- Batch data ---
+
+@dataclass
+class PollJob:
+    """Everything needed to poll a single user, detached from the DB session."""
+    user_id: int
+    access_token: str
+    refresh_token: str
+    expires_at: datetime.datetime
+
+@dataclass
+class PollResult:
+    """The outcome of polling a single user."""
+    user_id: int
+    currently_playing: dict | None = None
+    new_token_data: dict | None = None
+    refresh_failed: bool = False
+    error: Exception | None = None
+
+def build_track_data(currently_playing: dict | None):
+    """Converts a currently-playing response into the fields stored on `models.Track`."""
+    if currently_playing and currently_playing.get("is_playing"):
+        return {
+            "track_name": currently_playing["item"]["name"],
+            "artist_name": ", ".join(artist["name"] for artist in currently_playing["item"]["artists"]),
+            "album_cover_url": currently_playing["item"]["album"]["images"][0]["url"],
+            "spotify_track_url": currently_playing["item"]["external_urls"]["spotify"],
+            "currently_playing": True,
+            "spotify_track_id": currently_playing["item"].get("id"),
+        }
+    # A paused track keeps its id, so resuming it is not counted as a new play.
+    item = (currently_playing or {}).get("item") or {}
+    return { "track_name": "Not currently playing", "artist_name": "", "album_cover_url": "", "spotify_track_url": "", "currently_playing": False, "spotify_track_id": item.get("id") }
+
+# --- Change detection ---
+
+# Last observed fingerprint per user, so unchanged polls never touch the DB.
+# Least recently updated first.
+_fingerprints: OrderedDict[int, tuple[str | None, bool]] = OrderedDict()
+
+def fingerprint(track_data: dict):
+    """The part of a track state that counts as a change: (spotify track id, is playing)."""
+    return (track_data["spotify_track_id"], track_data["currently_playing"])
+
+def remember_fingerprints(fingerprints: dict[int, tuple[str | None, bool]]):
+    for user_id, value in fingerprints.items():
+        _fingerprints[user_id] = value
+        _fingerprints.move_to_end(user_id)
+    while len(_fingerprints) > POLL_FINGERPRINT_CACHE_SIZE:
+        _fingerprints.popitem(last=False)
+
+def has_changed(user_id: int, track_data: dict):
+    return _fingerprints.get(user_id) != fingerprint(track_data)
+
+def is_new_play(user_id: int, track_data: dict):
+    """True when a different track started playing; pausing and resuming the same track is not a play."""
+    track_id = track_data["spotify_track_id"]
+    if not track_data["currently_playing"] or not track_id:
+        return False
+    previous = _fingerprints.get(user_id)
+    return previous is None or previous[0] != track_id
+
+def build_play(user_id: int, currently_playing: dict, track_data: dict, now: datetime.datetime):
+    """
+    A play for `crud.record_plays`, dated back to when the track started.
+    `artists` lists every credited artist, so each gets its own rollup row.
+    """
+    progress = datetime.timedelta(milliseconds=currently_playing.get("progress_ms") or 0)
+    return {
+        "user_id": user_id,
+        "spotify_track_id": track_data["spotify_track_id"],
+        "track_name": track_data["track_name"],
+        "artist_name": track_data["artist_name"],
+        "artists": [artist["name"] for artist in currently_playing["item"]["artists"]],
+        "started_at": now - progress,
+    }
+
+def forget_user(user_id: int):
+    """Drops everything kept in memory for polling a user who stopped sharing."""
+    _fingerprints.pop(user_id, None)
+    scheduler.discard(user_id)
+    token_manager.manager.forget(user_id)
+
+# --- Failure backoff ---
+
+def failure_backoff(consecutive_errors: int):
+    """Seconds a user is skipped after their `consecutive_errors`-th failed poll in a row."""
+    return min(POLL_FAILURE_BACKOFF_BASE * 2 ** (consecutive_errors - 1), POLL_FAILURE_BACKOFF_MAX)
+
+def counts_against_user(error: Exception):
+    """
+    Whether a failed poll is the user's fault (revoked grant, deleted account,
+    an error only their requests get) rather than a throttle or a Spotify-wide outage.
+    """
+    if isinstance(error, RateLimited):
+        return False
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if spotify_breaker.is_open() and not (status and 400 <= status < 500):
+        return False
+    return True
+
+# --- Polling ---
+
+async def poll_user(job: PollJob):
+    """
+    Refreshes the user's access token if it has expired (normally the
+    refresh pass has already done so ahead of time), then fetches
+    what they are currently playing. Never raises; errors are returned
+    on the result so one failing user cannot abort the whole batch.
+    """
+    result = PollResult(user_id=job.user_id)
+    access_token = job.access_token
+
+    if job.expires_at < datetime.datetime.utcnow():
+        try:
+            result.new_token_data = await token_manager.manager.refresh(job.user_id, job.refresh_token)
+        except Exception as e:
+            # Only a revoked grant stops the share; throttling, 5xx and
+            # network errors are retried on a later poll, with backoff.
+            result.refresh_failed = token_manager.is_revoked(e)
+            result.error = e
+            return result
+        access_token = result.new_token_data["access_token"]
+
+    try:
+        result.currently_playing = await spotify.get_currently_playing_async(access_token)
+    except Exception as e:
+        metrics.record_error("currently_playing", e)
+        result.error = e
+    return result
+
+async def poll_batch(jobs: list[PollJob], concurrency: int = POLL_CONCURRENCY):
+    """
+    Polls every job in the batch concurrently over the shared Spotify client,
+    with at most `concurrency` requests in flight. Results are returned in
+    the same order as `jobs`.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(job: PollJob):
+        async with semaphore:
+            return await poll_user(job)
+
+    return await asyncio.gather(*(run(job) for job in jobs))
+
+# --- Batches ---
+
+@dataclass
+class BatchOutcome:
+    """What a committed batch polled and changed."""
+    polled: int
+    changed: list[dict]
+    spotify_ids: dict[int, str]
+    circuit_open: bool = False
+
+def write_batch(
+    db: Session,
+    revoked_user_ids: list[int],
+    token_rows: list[dict],
+    track_rows: list[dict],
+    plays: list[dict],
+    failures: list[dict],
+    schedules: list[dict],
+):
+    """Applies every write of a poll batch and commits them as one transaction."""
+    crud.bulk_stop_sharing(db, revoked_user_ids)
+    crud.bulk_upsert_tokens(db, token_rows)
+    crud.bulk_upsert_tracks(db, track_rows)
+    crud.record_plays(db, plays)
+    crud.bulk_update_poll_failures(db, failures)
+    crud.bulk_update_poll_schedules(db, schedules)
+    with metrics.DB_OPERATION_SECONDS.time(operation="commit_poll_batch"):
+        db.commit()
+
+async def run_batch(db: AsyncSession, batch: list, concurrency: int = POLL_CONCURRENCY, still_owner=None):
+    """
+    Polls the users of `batch` (rows from `crud.get_poll_batch`, which only
+    returns due shares) and writes every token, track, play and schedule
+    change in one transaction. Committed
+    track changes are published to readers through feed.py.
+    `still_owner()` is checked before writing; when it returns False the
+    batch is dropped, because another worker may own these users by now.
+    Nothing is polled while the Spotify circuit breaker is open.
+    """
+    if spotify_breaker.is_open():
+        return BatchOutcome(polled=0, changed=[], spotify_ids={}, circuit_open=True)
+
+    tokens = token_manager.manager
+    await db.run_sync(tokens.load, [row.user_id for row in batch])
+    jobs = []
+    for row in batch:
+        token = tokens.get(row.user_id)
+        if not token:
+            continue
+        jobs.append(PollJob(
+            user_id=row.user_id,
+            access_token=token.access_token,
+            refresh_token=token.refresh_token,
+            expires_at=token.expires_at,
+        ))
+    spotify_ids = {row.user_id: row.spotify_id for row in batch}
+    rows = {row.user_id: row for row in batch}
+    # The stored track state comes with the batch, so change detection needs no extra query.
+    remember_fingerprints({
+        row.user_id: (row.spotify_track_id, bool(row.currently_playing))
+        for row in batch if row.currently_playing is not None
+    })
+
+    results = await poll_batch(jobs, concurrency=concurrency)
+
+    # Collect every write of the batch and apply them in one transaction.
+    now = datetime.datetime.utcnow()
+    token_rows, track_rows, revoked_user_ids, plays, failures, schedules = [], [], [], [], [], []
+    for job, result in zip(jobs, results):
+        if result.refresh_failed:
+            revoked_user_ids.append(job.user_id)
+            forget_user(job.user_id)
+            continue
+        if result.new_token_data:
+            token_rows.append({
+                "user_id": job.user_id,
+                "access_token": result.new_token_data["access_token"],
+                "refresh_token": result.new_token_data.get("refresh_token", job.refresh_token),
+                "expires_at": result.new_token_data["expires_at"],
+            })
+        row = rows[job.user_id]
+        if result.error:
+            if counts_against_user(result.error):
+                consecutive_errors = (row.consecutive_errors or 0) + 1
+                failures.append({
+                    "share_id": row.share_id,
+                    "consecutive_errors": consecutive_errors,
+                    "last_error": metrics.error_cause(result.error),
+                    "next_eligible_at": now + datetime.timedelta(seconds=failure_backoff(consecutive_errors)),
+                })
+            continue
+        interval, idle_streak = scheduler.record(job.user_id, result.currently_playing, idle_streak=row.idle_streak)
+        schedules.append({
+            "share_id": row.share_id,
+            "next_poll_at": now + datetime.timedelta(seconds=interval),
+            "idle_streak": idle_streak,
+        })
+        try:
+            track_data = build_track_data(result.currently_playing)
+        except Exception as e:
+            metrics.record_error("build_track_data", e)
+            continue
+        if is_new_play(job.user_id, track_data):
+            plays.append(build_play(job.user_id, result.currently_playing, track_data, now))
+        if has_changed(job.user_id, track_data):
+            track_rows.append({"user_id": job.user_id, "updated_at": now, **track_data})
+
+    if still_owner is not None and not still_owner():
+        return BatchOutcome(polled=len(jobs), changed=[], spotify_ids=spotify_ids)
+
+    await db.run_sync(write_batch, revoked_user_ids, token_rows, track_rows, plays, failures, schedules)
+    remember_fingerprints({row["user_id"]: fingerprint(row) for row in track_rows})
+    await feed.publish(track_rows, spotify_ids)
+
+    metrics.POLL_BATCH_USERS.observe(len(batch), stage="selected")
+    metrics.POLL_BATCH_USERS.observe(len(jobs), stage="polled")
+    metrics.POLL_BATCH_USERS.observe(len(track_rows), stage="changed")
+    metrics.POLL_BATCH_USERS.observe(sum(1 for failure in failures if failure["consecutive_errors"]), stage="backed_off")
+    return BatchOutcome(polled=len(jobs), changed=track_rows, spotify_ids=spotify_ids)
@@ -0,0 +1,48 @@
+import asyncio
+from collections import defaultdict
+
+class Hub:
+    """
+    An in-process pub/sub hub with one topic per key (here: a Spotify id).
+
+    Each subscriber gets its own small queue. When a slow subscriber's
+    queue is full, its oldest message is dropped, since only the latest
+    now-playing state matters.
+    """
+
+    def __init__(self, queue_size: int = 8):
+        self.queue_size = queue_size
+        self._topics: dict[str, set[asyncio.Queue]] = defaultdict(set)
+
+    def subscribe(self, topic: str):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._topics[topic].add(queue)
+        return queue
+
+    def unsubscribe(self, topic: str, queue: asyncio.Queue):
+        subscribers = self._topics.get(topic)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._topics[topic]
+
+    def has_subscribers(self, topic: str):
+        return bool(self._topics.get(topic))
+
+    def subscriber_count(self, topic: str | None = None):
+        if topic is not None:
+            return len(self._topics.get(topic, ()))
+        return sum(len(subscribers) for subscribers in self._topics.values())
+
+    def publish(self, topic: str, message):
+        """Delivers `message` to every subscriber of `topic` and returns how many got it."""
+        subscribers = self._topics.get(topic, ())
+        for queue in subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+        return len(subscribers)
+
+# Process-wide hub for now-playing updates.
+hub = Hub()
@@ -0,0 +1,239 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+import metrics
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# App-wide budget for calls to Spotify, shared by every caller in the process.
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))  # requests per second
+SPOTIFY_RATE_BURST = int(os.getenv("SPOTIFY_RATE_BURST", "20"))
+# A call that would have to wait longer than this is deferred instead.
+SPOTIFY_RATE_MAX_WAIT = float(os.getenv("SPOTIFY_RATE_MAX_WAIT", "5"))
+
+# Circuit breaker: once at least SPOTIFY_BREAKER_MIN_CALLS calls were made in
+# the last SPOTIFY_BREAKER_WINDOW seconds and SPOTIFY_BREAKER_FAILURE_RATIO of
+# them failed with a 5xx or a network error, calls stop for
+# SPOTIFY_BREAKER_COOLDOWN seconds.
+SPOTIFY_BREAKER_FAILURE_RATIO = float(os.getenv("SPOTIFY_BREAKER_FAILURE_RATIO", "0.5"))
+SPOTIFY_BREAKER_MIN_CALLS = int(os.getenv("SPOTIFY_BREAKER_MIN_CALLS", "20"))
+SPOTIFY_BREAKER_WINDOW = float(os.getenv("SPOTIFY_BREAKER_WINDOW", "30"))
+SPOTIFY_BREAKER_COOLDOWN = float(os.getenv("SPOTIFY_BREAKER_COOLDOWN", "30"))
+
+class RateLimited(Exception):
+    """Raised when a call is deferred by the limiter or throttled by the upstream (HTTP 429)."""
+
+    def __init__(self, retry_after: float, message: str = "Rate limited"):
+        super().__init__(f"{message}; retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+class CircuitOpen(RateLimited):
+    """Raised instead of calling an upstream that is failing as a whole."""
+
+class TokenBucket:
+    """
+    A token-bucket rate limiter usable from both sync and async code.
+
+    Each call reserves one token; when the bucket is empty the caller waits
+    for its reservation, in arrival order. `pause()` blocks every caller
+    until a point in time, which is how an upstream `Retry-After` is
+    honoured. Calls that would wait longer than `max_wait` are deferred by
+    raising `RateLimited` instead of piling up.
+    """
+
+    def __init__(self, rate: float, burst: int, max_wait: float):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.deferred = 0
+        self.upstream_limited = 0
+
+    def set_budget(self, rate: float, burst: int | None = None):
+        """Changes the request budget for every caller of this limiter."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            if burst is not None:
+                self.burst = burst
+                self._tokens = min(self._tokens, float(burst))
+
+    def pause(self, seconds: float):
+        """Blocks all calls for `seconds`, e.g. after a 429 with `Retry-After`."""
+        with self._lock:
+            self.upstream_limited += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float):
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _reserve(self):
+        """Takes one token and returns how long the caller must wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(self._blocked_until - now, -self._tokens / self.rate if self._tokens < 0 else 0.0)
+            if wait > self.max_wait:
+                self._tokens += 1
+                self.deferred += 1
+                raise RateLimited(wait, "Request deferred by the rate limiter")
+            self.requests += 1
+            if wait > 0:
+                self.throttled += 1
+            return wait
+
+    async def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "deferred": self.deferred,
+            "upstream_limited": self.upstream_limited,
+        }
+
+class CircuitBreaker:
+    """
+    Stops all calls to an upstream while most recent calls to it fail.
+
+    Closed, calls pass and their outcomes are kept for `window` seconds.
+    When at least `min_calls` were seen and `failure_ratio` of them failed,
+    the breaker opens and `allow()` refuses every call for `cooldown`
+    seconds. It then half-opens and lets `probes` calls through: the first
+    success closes it, a failure opens it again.
+    """
+
+    def __init__(self, failure_ratio: float, min_calls: int, window: float, cooldown: float, probes: int = 3):
+        self._lock = threading.Lock()
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.probes = probes
+        self.state = "closed"
+        self._outcomes: deque[tuple[float, bool]] = deque()
+        self._failures = 0
+        self._opened_until = 0.0
+        self._probes_left = 0
+        self.opened = 0
+
+    def retry_after(self):
+        if self.state != "open":
+            return 0.0
+        return max(self._opened_until - time.monotonic(), 0.0)
+
+    def is_open(self):
+        """True while calls are refused outright; unlike `allow()`, uses up no probe."""
+        return self.state == "open" and time.monotonic() < self._opened_until
+
+    def allow(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                if now < self._opened_until:
+                    return False
+                self._half_open(now)
+            if self.state == "half_open":
+                if self._probes_left <= 0:
+                    # Probes that never reported back (deferred, 429) must not wedge the breaker.
+                    if now < self._opened_until:
+                        return False
+                    self._half_open(now)
+                self._probes_left -= 1
+            return True
+
+    def check(self):
+        """Raises `CircuitOpen` when calls are not allowed right now."""
+        if not self.allow():
+            raise CircuitOpen(self.retry_after(), "Circuit open after repeated upstream failures")
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            _, ok = self._outcomes.popleft()
+            if not ok:
+                self._failures -= 1
+
+    def _half_open(self, now: float):
+        self.state = "half_open"
+        self._probes_left = self.probes
+        self._opened_until = now + self.cooldown
+
+    def _open(self, now: float):
+        self.state = "open"
+        self.opened += 1
+        self._opened_until = now + self.cooldown
+        self._outcomes.clear()
+        self._failures = 0
+
+    def record_success(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self.state = "closed"
+                self._outcomes.clear()
+                self._failures = 0
+                return
+            self._outcomes.append((now, True))
+            self._trim(now)
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self._open(now)
+                return
+            if self.state == "open":
+                return
+            self._outcomes.append((now, False))
+            self._failures += 1
+            self._trim(now)
+            if len(self._outcomes) >= self.min_calls and self._failures >= self.failure_ratio * len(self._outcomes):
+                self._open(now)
+
+    def stats(self):
+        return {"state": self.state, "opened": self.opened, "retry_after": round(self.retry_after(), 1)}
+
+def parse_retry_after(value: str | None, default: float = 1.0):
+    """Parses a `Retry-After` header given in seconds."""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+# Shared limiter in front of every Spotify call made by this process.
+spotify_limiter = TokenBucket(SPOTIFY_RATE_LIMIT, SPOTIFY_RATE_BURST, SPOTIFY_RATE_MAX_WAIT)
+
+# Shared breaker in front of every Spotify call made by this process.
+spotify_breaker = CircuitBreaker(
+    SPOTIFY_BREAKER_FAILURE_RATIO, SPOTIFY_BREAKER_MIN_CALLS, SPOTIFY_BREAKER_WINDOW, SPOTIFY_BREAKER_COOLDOWN,
+)
+
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+metrics.registry.callback(
+    "spotify_circuit_state", "Spotify circuit breaker state (0 closed, 1 half-open, 2 open).", (),
+    lambda: {(): CIRCUIT_STATES[spotify_breaker.state]})
+metrics.registry.callback(
+    "spotify_circuit_opened_total", "Times the Spotify circuit breaker opened.", (),
+    lambda: {(): spotify_breaker.opened}, kind="counter")
+metrics.registry.callback(
+    "spotify_rate_limiter_total", "Spotify calls seen by the rate limiter, by outcome.", ("result",),
+    lambda: {(result,): count for result, count in spotify_limiter.stats().items()}, kind="counter")
@@ -0,0 +1,273 @@
+"""
+Live now-playing lookups for /users/{spotify_id}/now-playing/live.
+
+Users who linked a Last.fm account can be answered by Spotify or Last.fm.
+The preferred provider is asked first; if it has not answered within its
+recent p95 latency, the other one is asked too (a hedged request) and the
+first valid answer wins, the slower request is cancelled. Hedges draw on
+a budget of a small share of lookups, so a slow provider cannot double
+upstream traffic. A provider that fails is replaced by the other at once.
+
+Answers are cached for NOW_PLAYING_LIVE_TTL seconds, and concurrent
+lookups for the same user share one resolve, so a popular profile costs
+at most one upstream lookup per TTL.
+"""
+import os
+import time
+import asyncio
+import datetime
+from collections import deque
+from dataclasses import dataclass
+import crud_async
+import lastfm
+import metrics
+import nowplaying
+import poller
+import spotify
+import token_manager
+from cache import CACHE_URL, SWRCache, TTLCache, make_backend
+from database import AsyncSessionLocal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Provider asked first for users linked to both: "spotify" or "lastfm".
+NOW_PLAYING_PREFERRED_PROVIDER = os.getenv("NOW_PLAYING_PREFERRED_PROVIDER", "spotify")
+# The hedge is sent after this percentile of the first provider's recent latencies,
+# clamped to [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY] seconds; HEDGE_DEFAULT_DELAY until
+# HEDGE_MIN_SAMPLES latencies are known.
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "0.5"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "2"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 500
+# At most this share of lookups send a hedge, with bursts of up to HEDGE_BURST.
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))
+HEDGE_BURST = 10
+# A lookup gives up after this many seconds, whoever is still running.
+NOW_PLAYING_RESOLVE_TIMEOUT = float(os.getenv("NOW_PLAYING_RESOLVE_TIMEOUT", "5"))
+# Seconds a user's linked accounts are cached for.
+NOW_PLAYING_LINK_TTL = float(os.getenv("NOW_PLAYING_LINK_TTL", "300"))
+# Seconds a live answer is shared by every request for the same user.
+NOW_PLAYING_LIVE_TTL = float(os.getenv("NOW_PLAYING_LIVE_TTL", "3"))
+
+PROVIDERS = ("spotify", "lastfm")
+
+# --- Latency tracking ---
+
+class LatencyWindow:
+    """The latest `size` latencies of one provider."""
+
+    def __init__(self, size: int = HEDGE_WINDOW):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float):
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class HedgeBudget:
+    """
+    Every lookup that could hedge earns `ratio` of a hedge, up to `burst`;
+    a hedge spends a whole one. Keeps hedges near `ratio` of lookups even
+    when a provider is slow for every request.
+    """
+
+    def __init__(self, ratio: float = HEDGE_BUDGET_RATIO, burst: float = HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+
+    def deposit(self):
+        self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self):
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+latencies = {provider: LatencyWindow() for provider in PROVIDERS}
+hedge_budget = HedgeBudget()
+
+def hedge_delay(provider: str):
+    """Seconds to wait for `provider` before hedging."""
+    window = latencies[provider]
+    if len(window) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return min(max(window.percentile(HEDGE_PERCENTILE), HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+# --- Normalizing ---
+
+def from_spotify(currently_playing: dict | None):
+    return nowplaying.to_response(poller.build_track_data(currently_playing))
+
+# --- Providers ---
+
+@dataclass
+class Link:
+    """The accounts a user's now playing can be read from."""
+    user_id: int
+    spotify_id: str
+    lastfm_username: str | None
+    has_spotify_token: bool
+
+    def providers(self):
+        available = [
+            provider for provider, linked in (("spotify", self.has_spotify_token), ("lastfm", self.lastfm_username))
+            if linked
+        ]
+        available.sort(key=lambda provider: provider != NOW_PLAYING_PREFERRED_PROVIDER)
+        return available
+
+_links = TTLCache(maxsize=10000, ttl=NOW_PLAYING_LINK_TTL)
+
+async def get_link(spotify_id: str):
+    """Returns the user's `Link`, cached for NOW_PLAYING_LINK_TTL seconds; None for unknown users."""
+    link = _links.get(spotify_id)
+    if link is not None:
+        return link
+    async with AsyncSessionLocal() as db:
+        user = await crud_async.get_user_by_spotify_id(db, spotify_id)
+        if user is None:
+            return None
+        await db.run_sync(token_manager.manager.load, [user.id])
+    link = Link(user.id, spotify_id, user.lastfm_username, token_manager.manager.get(user.id) is not None)
+    _links.set(spotify_id, link)
+    return link
+
+def forget_link(spotify_id: str):
+    _links.invalidate(spotify_id)
+
+async def _refresh_token(user_id: int, refresh_token: str):
+    token_data = await token_manager.manager.refresh(user_id, refresh_token)
+    async with AsyncSessionLocal() as db:
+        await crud_async.bulk_upsert_tokens(db, [{
+            "user_id": user_id,
+            "access_token": token_data["access_token"],
+            "refresh_token": token_data["refresh_token"],
+            "expires_at": token_data["expires_at"],
+        }])
+        await db.commit()
+    return token_data
+
+async def fetch_spotify(link: Link):
+    token = token_manager.manager.get(link.user_id)
+    if token is None or token.expires_at < datetime.datetime.utcnow():
+        # Dropped from memory since the link was cached (e.g. when the share
+        # stopped), or maybe refreshed by another process since it was loaded.
+        async with AsyncSessionLocal() as db:
+            await db.run_sync(token_manager.manager.load, [link.user_id])
+        token = token_manager.manager.get(link.user_id)
+    if token is None:
+        raise LookupError("No Spotify token for this user")
+    access_token = token.access_token
+    if token.expires_at < datetime.datetime.utcnow():
+        # Shielded: a lost hedge must not cancel a refresh the poller may be waiting on too.
+        token_data = await asyncio.shield(_refresh_token(link.user_id, token.refresh_token))
+        access_token = token_data["access_token"]
+    return from_spotify(await spotify.get_currently_playing_async(access_token))
+
+async def fetch_lastfm(link: Link):
+    return nowplaying.from_lastfm(await lastfm.get_recent_tracks(link.lastfm_username))
+
+FETCHERS = {"spotify": fetch_spotify, "lastfm": fetch_lastfm}
+
+# --- Resolving ---
+
+async def _timed(provider: str, link: Link):
+    started, outcome = time.perf_counter(), "error"
+    try:
+        response = await FETCHERS[provider](link)
+        outcome = "ok"
+        return response
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        # A cancelled call took at least this long, which is what the hedge delay needs to know.
+        latencies[provider].observe(elapsed)
+        metrics.NOW_PLAYING_PROVIDER_SECONDS.observe(elapsed, provider=provider, outcome=outcome)
+
+async def resolve(link: Link, timeout: float = NOW_PLAYING_RESOLVE_TIMEOUT):
+    """
+    Returns `(response, provider)` with the first valid answer of the
+    user's providers, preferred first. Raises the first provider error
+    when every provider failed, or TimeoutError after `timeout` seconds.
+    """
+    queue = link.providers()
+    if not queue:
+        raise LookupError("No now-playing provider linked")
+    if len(queue) > 1:
+        hedge_budget.deposit()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    hedge_at = loop.time() + hedge_delay(queue[0])
+    pending: dict[asyncio.Task, str] = {}
+    errors: list[Exception] = []
+    hedged = False
+
+    def start():
+        provider = queue.pop(0)
+        pending[asyncio.ensure_future(_timed(provider, link))] = provider
+
+    start()
+    try:
+        while pending:
+            wait = deadline - loop.time()
+            if queue:
+                wait = min(wait, hedge_at - loop.time())
+            done, _ = await asyncio.wait(pending, timeout=max(wait, 0), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = pending.pop(task)
+                error = task.exception()
+                if error is None:
+                    metrics.NOW_PLAYING_RESOLVES.inc(provider=provider, hedged=str(hedged).lower())
+                    return task.result(), provider
+                metrics.record_error(f"now_playing_{provider}", error)
+                errors.append(error)
+            if loop.time() >= deadline:
+                break
+            if queue and not pending:
+                # Failing over is not a duplicate call, so it needs no budget.
+                start()
+            elif queue and loop.time() >= hedge_at:
+                if hedge_budget.try_spend():
+                    hedged = True
+                    start()
+                else:
+                    hedge_at = deadline
+    finally:
+        for task in pending:
+            task.cancel()
+    if errors:
+        raise errors[0]
+    raise TimeoutError(f"No now-playing provider answered within {timeout}s")
+
+# --- Caching ---
+
+# "<provider>\n<body>" by Spotify id. Never served stale: a live answer
+# older than the TTL is no better than the poller's.
+live_cache = SWRCache(
+    ttl=NOW_PLAYING_LIVE_TTL, stale_ttl=0,
+    backend=make_backend(CACHE_URL, namespace="now-playing:v1:live:", maxsize=10000),
+)
+metrics.register_cache("live_now_playing", live_cache)
+
+async def _load_live(link: Link):
+    response, provider = await resolve(link)
+    return provider.encode() + b"\n" + response.model_dump_json().encode()
+
+async def lookup(link: Link):
+    """Returns `(body, provider)` for the user, from `resolve` or from a lookup at most NOW_PLAYING_LIVE_TTL seconds old."""
+    entry = await live_cache.get(link.spotify_id, lambda: _load_live(link))
+    provider, _, body = entry.partition(b"\n")
+    return body, provider.decode()
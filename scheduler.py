@@ -0,0 +1,129 @@
+import os
+import time
+import heapq
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Extra time allowed after the predicted end of a track before polling again.
+TRACK_END_SLACK = float(os.getenv("SCHEDULER_TRACK_END_SLACK", "2"))
+# Bounds on the wait while a track is playing. The upper bound limits how
+# long a skipped track can go unnoticed.
+PLAYING_MIN_INTERVAL = float(os.getenv("SCHEDULER_PLAYING_MIN_INTERVAL", "5"))
+PLAYING_MAX_INTERVAL = float(os.getenv("SCHEDULER_PLAYING_MAX_INTERVAL", "180"))
+# Paused or idle users back off exponentially between these bounds.
+IDLE_BASE_INTERVAL = float(os.getenv("SCHEDULER_IDLE_BASE_INTERVAL", "30"))
+IDLE_MAX_INTERVAL = float(os.getenv("SCHEDULER_IDLE_MAX_INTERVAL", "900"))
+
+@dataclass
+class _Entry:
+    due_at: float
+    idle_streak: int = 0
+
+class PollScheduler:
+    """
+    A priority queue of users keyed by the time they are next due for a poll.
+
+    While a track is playing, the user is due again shortly after the track
+    is predicted to end (from `progress_ms` and `item.duration_ms`). Paused
+    or idle users back off exponentially and return to the fast cadence as
+    soon as a poll sees them playing again. Users the scheduler has never
+    seen are always due.
+
+    The poller stores each new schedule with the share, and the database
+    only returns due shares, so the schedule holds across serverless
+    invocations and workers; this copy answers `next_due_at()`, which
+    worker.py sleeps until. It uses lazy deletion: rescheduling pushes a
+    new item, stale items are dropped when they reach the top, and the heap
+    is rebuilt once stale items outnumber live ones, so it stays O(users).
+    """
+
+    def __init__(
+        self,
+        track_end_slack: float = TRACK_END_SLACK,
+        playing_min_interval: float = PLAYING_MIN_INTERVAL,
+        playing_max_interval: float = PLAYING_MAX_INTERVAL,
+        idle_base_interval: float = IDLE_BASE_INTERVAL,
+        idle_max_interval: float = IDLE_MAX_INTERVAL,
+    ):
+        self.track_end_slack = track_end_slack
+        self.playing_min_interval = playing_min_interval
+        self.playing_max_interval = playing_max_interval
+        self.idle_base_interval = idle_base_interval
+        self.idle_max_interval = idle_max_interval
+        self._heap: list[tuple[float, int]] = []
+        self._entries: dict[int, _Entry] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_due(self, user_id: int, now: float | None = None):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return True
+        return entry.due_at <= (time.monotonic() if now is None else now)
+
+    def due_at(self, user_id: int):
+        entry = self._entries.get(user_id)
+        return entry.due_at if entry else None
+
+    def schedule(self, user_id: int, due_at: float):
+        """Sets the user's next due time, keeping their idle streak."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = _Entry(due_at)
+        entry.due_at = due_at
+        heapq.heappush(self._heap, (due_at, user_id))
+        self._maybe_compact()
+
+    def discard(self, user_id: int):
+        self._entries.pop(user_id, None)
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(entry.due_at, user_id) for user_id, entry in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def next_interval(self, currently_playing: dict | None, idle_streak: int):
+        """Seconds until the next poll for the given currently-playing response."""
+        item = (currently_playing or {}).get("item") or {}
+        if currently_playing and currently_playing.get("is_playing") and item.get("duration_ms"):
+            remaining_ms = item["duration_ms"] - (currently_playing.get("progress_ms") or 0)
+            interval = max(remaining_ms, 0) / 1000 + self.track_end_slack
+            return min(max(interval, self.playing_min_interval), self.playing_max_interval)
+        # The exponent is capped: a user idle for weeks would overflow the float.
+        return min(self.idle_base_interval * (2 ** min(idle_streak, 32)), self.idle_max_interval)
+
+    def record(self, user_id: int, currently_playing: dict | None, idle_streak: int | None = None, now: float | None = None):
+        """
+        Reschedules the user after a successful poll and returns `(interval,
+        idle_streak)`: the seconds until their next poll and their new idle
+        streak, for storing with the share. `idle_streak` replaces the one
+        remembered here, e.g. with the stored one.
+        """
+        now = time.monotonic() if now is None else now
+        if idle_streak is None:
+            entry = self._entries.get(user_id)
+            idle_streak = entry.idle_streak if entry else 0
+        playing = bool(currently_playing and currently_playing.get("is_playing"))
+
+        interval = self.next_interval(currently_playing, 0 if playing else idle_streak)
+        idle_streak = 0 if playing else idle_streak + 1
+        self.schedule(user_id, now + interval)
+        self._entries[user_id].idle_streak = idle_streak
+        return interval, idle_streak
+
+    def next_due_at(self):
+        """The earliest due time of any known user, or None when empty."""
+        while self._heap:
+            due_at, user_id = self._heap[0]
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.due_at == due_at:
+                return due_at
+            heapq.heappop(self._heap)
+        return None
+
+# Process-wide scheduler shared by every batch handled by this instance.
+scheduler = PollScheduler()
@@ -1,25 +1,39 @@
 import os
-import requests
+import importlib.util
+import time
+import asyncio
 import base64
 import datetime
+import metrics
+import ratelimit
+from asyncutil import LoopLocal
 from urllib.parse import urlencode
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# HTTP/2 needs the optional `h2` package (installed with `httpx[http2]`).
+# Only look it up here; httpx imports it when the first client is created.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
 # Load Spotify credentials from environment variables
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
 
-# Spotify API endpoints
+# Spotify API endpoints (overridable so benchmarks can point at a local stand-in)
 SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
-SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_API_BASE_URL = "https://api.spotify.com/v1"
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+SPOTIFY_API_BASE_URL = os.getenv("SPOTIFY_API_BASE_URL", "https://api.spotify.com/v1")
 
 # Scopes define the permissions our app is requesting
 SCOPES = "user-read-currently-playing user-read-playback-state"
 
+# Connection settings shared by every request to Spotify
+SPOTIFY_CONNECT_TIMEOUT = float(os.getenv("SPOTIFY_CONNECT_TIMEOUT", "3"))
+SPOTIFY_READ_TIMEOUT = float(os.getenv("SPOTIFY_READ_TIMEOUT", "10"))
+SPOTIFY_MAX_CONNECTIONS = int(os.getenv("SPOTIFY_MAX_CONNECTIONS", "100"))
+
 def get_auth_url():
     """Constructs the Spotify authorization URL."""
     params = {
@@ -30,21 +44,9 @@ def get_auth_url():
     }
     return f"{SPOTIFY_AUTH_URL}?{urlencode(params)}"
 
-def get_token_data_from_code(code: str):
-    """Exchanges an authorization code for an access token and refresh token."""
-    auth_header = base64.b64encode(
-        f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}".encode("ascii")
-    ).decode("ascii")
-
-    response = requests.post(
-        SPOTIFY_TOKEN_URL,
-        headers={"Authorization": f"Basic {auth_header}"},
-        data={
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": SPOTIFY_REDIRECT_URI,
-        },
-    )
+# --- Response parsing ---
+
+def _parse_token_response(response: "httpx.Response"):
     response.raise_for_status()
     token_data = response.json()
     # Add an 'expires_at' timestamp
@@ -53,41 +55,224 @@ def get_token_data_from_code(code: str):
     )
     return token_data
 
+def _parse_json_response(response: "httpx.Response"):
+    if response.status_code == 204:  # No content
+        return None
+    response.raise_for_status()
+    return response.json()
+
+# --- Client ---
+
+class SpotifyClient:
+    """
+    A long-lived Spotify client.
+
+    It owns one pooled keep-alive connection per host (HTTP/2 when `h2` is
+    installed) for both the sync and the async API, so repeated calls to
+    api.spotify.com and accounts.spotify.com skip the TCP/TLS handshake.
+    The Basic auth header for the token endpoint is computed once.
+
+    Every request first takes a token from the shared rate limiter. A 429
+    pauses the limiter for `Retry-After` seconds and raises
+    `ratelimit.RateLimited`. 5xx responses and network errors feed the
+    shared circuit breaker; while it is open, requests fail fast with
+    `ratelimit.CircuitOpen` without reaching Spotify.
+    """
+
+    def __init__(
+        self,
+        client_id: str | None = SPOTIFY_CLIENT_ID,
+        client_secret: str | None = SPOTIFY_CLIENT_SECRET,
+        redirect_uri: str | None = SPOTIFY_REDIRECT_URI,
+        connect_timeout: float = SPOTIFY_CONNECT_TIMEOUT,
+        read_timeout: float = SPOTIFY_READ_TIMEOUT,
+        max_connections: int = SPOTIFY_MAX_CONNECTIONS,
+        http2: bool = HTTP2_AVAILABLE,
+        limiter: ratelimit.TokenBucket = ratelimit.spotify_limiter,
+        breaker: ratelimit.CircuitBreaker = ratelimit.spotify_breaker,
+    ):
+        self.redirect_uri = redirect_uri
+        self.limiter = limiter
+        self.breaker = breaker
+        self._basic_auth = "Basic " + base64.b64encode(
+            f"{client_id}:{client_secret}".encode("ascii")
+        ).decode("ascii")
+        # httpx is imported with the first client, so cold starts that never call Spotify skip it.
+        import httpx
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60,
+        )
+        self._http2 = http2
+        self._sync_client: httpx.Client | None = None
+        self._async_client = LoopLocal(
+            lambda: httpx.AsyncClient(http2=self._http2, timeout=self._timeout, limits=self._limits)
+        )
+
+    @property
+    def sync_client(self):
+        if self._sync_client is None:
+            import httpx
+            self._sync_client = httpx.Client(http2=self._http2, timeout=self._timeout, limits=self._limits)
+        return self._sync_client
+
+    @property
+    def async_client(self):
+        return self._async_client.get()
+
+    def close(self):
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+    async def aclose(self):
+        client = self._async_client.pop()
+        if client is not None:
+            await client.aclose()
+
+    def _check_rate_limit(self, response: "httpx.Response"):
+        if response.status_code == 429:
+            retry_after = ratelimit.parse_retry_after(response.headers.get("Retry-After"))
+            self.limiter.pause(retry_after)
+            raise ratelimit.RateLimited(retry_after, "Spotify returned 429")
+        return response
+
+    def _record_outcome(self, status):
+        if status == "cancelled":
+            # Abandoned by the caller (e.g. a hedged lookup that lost); says nothing about Spotify.
+            return
+        if status == "error" or status >= 500:
+            self.breaker.record_failure()
+        elif status != 429:
+            self.breaker.record_success()
+
+    def _request(self, endpoint: str, method: str, url: str, **kwargs):
+        self.breaker.check()
+        self.limiter.acquire_sync()
+        started, status = time.perf_counter(), "error"
+        try:
+            response = self.sync_client.request(method, url, **kwargs)
+            status = response.status_code
+        finally:
+            metrics.SPOTIFY_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, status=status)
+            self._record_outcome(status)
+        return self._check_rate_limit(response)
+
+    async def _request_async(self, endpoint: str, method: str, url: str, **kwargs):
+        self.breaker.check()
+        await self.limiter.acquire()
+        started, status = time.perf_counter(), "error"
+        try:
+            response = await self.async_client.request(method, url, **kwargs)
+            status = response.status_code
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            metrics.SPOTIFY_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, status=status)
+            self._record_outcome(status)
+        return self._check_rate_limit(response)
+
+    def _code_grant(self, code: str):
+        return {"grant_type": "authorization_code", "code": code, "redirect_uri": self.redirect_uri}
+
+    @staticmethod
+    def _refresh_grant(refresh_token: str):
+        return {"grant_type": "refresh_token", "refresh_token": refresh_token}
+
+    @staticmethod
+    def _bearer(access_token: str):
+        return {"Authorization": f"Bearer {access_token}"}
+
+    # --- Sync API ---
+
+    def get_token_data_from_code(self, code: str):
+        """Exchanges an authorization code for an access token and refresh token."""
+        response = self._request(
+            "token", "POST", SPOTIFY_TOKEN_URL, headers={"Authorization": self._basic_auth}, data=self._code_grant(code)
+        )
+        return _parse_token_response(response)
+
+    def refresh_access_token(self, refresh_token: str):
+        """Refreshes an expired access token using a refresh token."""
+        response = self._request(
+            "token", "POST", SPOTIFY_TOKEN_URL, headers={"Authorization": self._basic_auth}, data=self._refresh_grant(refresh_token)
+        )
+        return _parse_token_response(response)
+
+    def get_user_profile(self, access_token: str):
+        """Fetches the profile of the user associated with the access token."""
+        response = self._request("me", "GET", f"{SPOTIFY_API_BASE_URL}/me", headers=self._bearer(access_token))
+        return _parse_json_response(response)
+
+    def get_currently_playing(self, access_token: str):
+        """Fetches the user's currently playing track."""
+        response = self._request(
+            "currently_playing", "GET", f"{SPOTIFY_API_BASE_URL}/me/player/currently-playing", headers=self._bearer(access_token)
+        )
+        return _parse_json_response(response)
+
+    # --- Async API ---
+
+    async def get_token_data_from_code_async(self, code: str):
+        response = await self._request_async(
+            "token", "POST", SPOTIFY_TOKEN_URL, headers={"Authorization": self._basic_auth}, data=self._code_grant(code)
+        )
+        return _parse_token_response(response)
+
+    async def refresh_access_token_async(self, refresh_token: str):
+        response = await self._request_async(
+            "token", "POST", SPOTIFY_TOKEN_URL, headers={"Authorization": self._basic_auth}, data=self._refresh_grant(refresh_token)
+        )
+        return _parse_token_response(response)
+
+    async def get_user_profile_async(self, access_token: str):
+        response = await self._request_async("me", "GET", f"{SPOTIFY_API_BASE_URL}/me", headers=self._bearer(access_token))
+        return _parse_json_response(response)
+
+    async def get_currently_playing_async(self, access_token: str):
+        response = await self._request_async(
+            "currently_playing", "GET", f"{SPOTIFY_API_BASE_URL}/me/player/currently-playing", headers=self._bearer(access_token)
+        )
+        return _parse_json_response(response)
+
+_client: SpotifyClient | None = None
+
+def get_client():
+    """Returns the process-wide `SpotifyClient`, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = SpotifyClient()
+    return _client
+
+# --- Module-level shortcuts on the shared client ---
+
+def get_token_data_from_code(code: str):
+    """Exchanges an authorization code for an access token and refresh token."""
+    return get_client().get_token_data_from_code(code)
+
 def refresh_access_token(refresh_token: str):
     """Refreshes an expired access token using a refresh token."""
-    auth_header = base64.b64encode(
-        f"{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}".encode("ascii")
-    ).decode("ascii")
-
-    response = requests.post(
-        SPOTIFY_TOKEN_URL,
-        headers={"Authorization": f"Basic {auth_header}"},
-        data={"grant_type": "refresh_token", "refresh_token": refresh_token},
-    )
-    response.raise_for_status()
-    token_data = response.json()
-    # Add an 'expires_at' timestamp
-    token_data["expires_at"] = datetime.datetime.utcnow() + datetime.timedelta(
-        seconds=token_data["expires_in"]
-    )
-    return token_data
+    return get_client().refresh_access_token(refresh_token)
 
 def get_user_profile(access_token: str):
     """Fetches the profile of the user associated with the access token."""
-    response = requests.get(
-        f"{SPOTIFY_API_BASE_URL}/me",
-        headers={"Authorization": f"Bearer {access_token}"},
-    )
-    response.raise_for_status()
-    return response.json()
+    return get_client().get_user_profile(access_token)
 
 def get_currently_playing(access_token: str):
     """Fetches the user's currently playing track."""
-    response = requests.get(
-        f"{SPOTIFY_API_BASE_URL}/me/player/currently-playing",
-        headers={"Authorization": f"Bearer {access_token}"},
-    )
-    if response.status_code == 204:  # No content
-        return None
-    response.raise_for_status()
-    return response.json()
+    return get_client().get_currently_playing(access_token)
+
+async def get_token_data_from_code_async(code: str):
+    return await get_client().get_token_data_from_code_async(code)
+
+async def refresh_access_token_async(refresh_token: str):
+    return await get_client().refresh_access_token_async(refresh_token)
+
+async def get_user_profile_async(access_token: str):
+    return await get_client().get_user_profile_async(access_token)
+
+async def get_currently_playing_async(access_token: str):
+    return await get_client().get_currently_playing_async(access_token)
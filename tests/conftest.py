@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# The app reads its configuration at import time, so point it at a scratch
+# SQLite database before any test module imports it.
+_tmpdir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir.name, 'test.db')}"
+os.environ.setdefault("CACHE_URL", "memory://")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+@pytest.fixture
+def db():
+    """A sync session on an empty schema."""
+    engine = database.get_engine()
+    database.Base.metadata.drop_all(bind=engine)
+    database.create_db_and_tables()
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+class FakeClock:
+    """A `time.monotonic` stand-in that only moves when told to."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freezes `time.monotonic` for code that reads it through the `time` module."""
+    fake = FakeClock()
+    monkeypatch.setattr("time.monotonic", fake)
+    return fake
@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import pytest
+import crud
+import cycles
+import models
+import poller
+from database import AsyncSessionLocal
+
+@pytest.fixture
+def shares(db):
+    """Five sharing users; returns their share ids in poll order."""
+    ids = []
+    for n in range(5):
+        user = crud.create_user(db, spotify_id=f"user{n}", display_name=f"User {n}", profile_pic_url=None)
+        ids.append(crud.start_sharing(db, user.id).id)
+    return ids
+
+@pytest.fixture
+def polled(monkeypatch):
+    """Replaces `poller.run_batch`; returns the share ids of every batch it was given."""
+    batches = []
+
+    async def run_batch(db, batch, concurrency=None, still_owner=None):
+        batches.append([row.share_id for row in batch])
+        return poller.BatchOutcome(polled=len(batch), changed=[], spotify_ids={})
+
+    monkeypatch.setattr(poller, "run_batch", run_batch)
+    return batches
+
+def run_slice(**kwargs):
+    async def go():
+        async with AsyncSessionLocal() as db:
+            return await cycles.run_slice(db, **kwargs)
+    return asyncio.run(go())
+
+def lock_cycle(db, owner: str, cursor: int = 0, locked_for: float = 60):
+    """Starts cycle 1 as `owner`, checkpointed at `cursor` and locked for `locked_for` seconds."""
+    now = datetime.datetime.utcnow()
+    crud.start_poll_cycle(db, 1, owner, now, now + datetime.timedelta(seconds=locked_for))
+    crud.checkpoint_poll_cycle(db, 1, owner, cursor, 0, None, now)
+
+def test_slice_polls_a_new_cycle_in_chunks(db, shares, polled):
+    result = run_slice(chunk_size=2)
+
+    assert polled == [shares[0:2], shares[2:4], shares[4:5]]
+    assert (result.cycle_id, result.cursor, result.polled, result.chunks) == (1, shares[-1], 5, 3)
+    assert result.finished and not result.should_continue
+    cycle = crud.get_latest_poll_cycle(db)
+    assert cycle.finished_at is not None and cycle.owner is None and cycle.polled == 5
+
+def test_slice_skips_a_cycle_locked_by_another_invocation(db, shares, polled):
+    lock_cycle(db, "other")
+
+    result = run_slice()
+
+    assert result.busy and result.cycle_id == 1
+    assert polled == []
+    assert crud.get_latest_poll_cycle(db).owner == "other"
+
+def test_slice_resumes_from_the_saved_cursor(db, shares, polled):
+    lock_cycle(db, "other", cursor=shares[1], locked_for=-1)
+
+    result = run_slice(resume_cycle=1, chunk_size=10)
+
+    assert polled == [shares[2:]]
+    assert result.finished and result.cursor == shares[-1] and result.polled == 3
+    assert crud.get_latest_poll_cycle(db).invocations == 2
+
+def test_continuation_for_another_cycle_stops(db, shares, polled):
+    lock_cycle(db, "other", locked_for=-1)
+
+    result = run_slice(resume_cycle=7)
+
+    assert result.cycle_id is None and result.finished and not result.should_continue
+    assert polled == []
+
+def test_slice_stops_when_its_cycle_is_taken_over(db, shares, monkeypatch):
+    async def run_batch(db_, batch, concurrency=None, still_owner=None):
+        # The lock ran out mid-chunk and another invocation took the cycle over.
+        db.query(models.PollCycle).update({"owner": "thief"})
+        db.commit()
+        return poller.BatchOutcome(polled=len(batch), changed=[], spotify_ids={})
+
+    monkeypatch.setattr(poller, "run_batch", run_batch)
+
+    result = run_slice(chunk_size=2)
+
+    assert result.busy and result.chunks == 0 and result.polled == 0
+    cycle = crud.get_latest_poll_cycle(db)
+    db.refresh(cycle)
+    assert cycle.owner == "thief" and cycle.cursor == 0 and cycle.finished_at is None
+
+def test_slice_out_of_time_unlocks_for_the_continuation(db, shares, polled):
+    # The last cycle measured 100s per user, far more than the budget allows.
+    now = datetime.datetime.utcnow()
+    crud.start_poll_cycle(db, 1, "old", now, now)
+    crud.checkpoint_poll_cycle(db, 1, "old", shares[-1], 5, 100.0, now, finished=True)
+
+    result = run_slice(budget=8, chunk_size=2)
+
+    # Every invocation polls at least one user, then hands over.
+    assert polled == [shares[0:1]]
+    assert result.cycle_id == 2 and result.cursor == shares[0]
+    assert result.should_continue
+    assert crud.get_latest_poll_cycle(db).owner is None
@@ -0,0 +1,139 @@
+import pytest
+from ratelimit import CircuitBreaker, CircuitOpen, RateLimited, TokenBucket
+
+# --- CircuitBreaker ---
+
+def make_breaker(**kwargs):
+    options = {"failure_ratio": 0.5, "min_calls": 4, "window": 30, "cooldown": 10, "probes": 2}
+    return CircuitBreaker(**{**options, **kwargs})
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record_failure()
+    assert breaker.state == "open"
+
+def test_breaker_stays_closed_below_min_calls(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+
+    assert breaker.state == "closed" and breaker.allow()
+
+def test_breaker_opens_at_the_failure_ratio(clock):
+    breaker = make_breaker()
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+
+    assert breaker.state == "open" and breaker.opened == 1
+    assert breaker.is_open() and not breaker.allow()
+    with pytest.raises(CircuitOpen) as error:
+        breaker.check()
+    assert error.value.retry_after == 10
+
+def test_breaker_forgets_outcomes_older_than_the_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    clock.advance(31)
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+def test_breaker_half_opens_after_the_cooldown_with_limited_probes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(9)
+    assert not breaker.allow()
+    clock.advance(1)
+
+    assert not breaker.is_open()
+    assert breaker.allow() and breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+def test_breaker_half_open_success_closes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(10)
+    assert breaker.allow()
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    # The outcomes from before the outage are gone.
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+def test_breaker_half_open_failure_reopens(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(10)
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == "open" and breaker.opened == 2
+    assert breaker.retry_after() == 10
+
+def test_breaker_unanswered_probes_half_open_again(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(10)
+    assert breaker.allow() and breaker.allow()
+    # Both probes were deferred and never reported back.
+    clock.advance(10)
+
+    assert breaker.allow() and breaker.state == "half_open"
+
+# --- TokenBucket ---
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records `time.sleep` calls instead of sleeping."""
+    calls = []
+    monkeypatch.setattr("time.sleep", calls.append)
+    return calls
+
+def test_bucket_allows_a_burst_then_throttles(clock, sleeps):
+    bucket = TokenBucket(rate=2, burst=3, max_wait=5)
+    for _ in range(3):
+        bucket.acquire_sync()
+    assert sleeps == []
+
+    bucket.acquire_sync()
+    bucket.acquire_sync()
+
+    assert sleeps == [0.5, 1.0]
+    assert bucket.stats() == {"requests": 5, "throttled": 2, "deferred": 0, "upstream_limited": 0}
+
+def test_bucket_defers_calls_that_would_wait_too_long(clock, sleeps):
+    bucket = TokenBucket(rate=1, burst=1, max_wait=2)
+    bucket.acquire_sync()
+    bucket.acquire_sync()
+    bucket.acquire_sync()
+
+    with pytest.raises(RateLimited) as error:
+        bucket.acquire_sync()
+    assert error.value.retry_after == 3
+    assert bucket.deferred == 1
+    # The deferred call gave its token back, so the next one waits no longer.
+    with pytest.raises(RateLimited) as error:
+        bucket.acquire_sync()
+    assert error.value.retry_after == 3
+
+    clock.advance(1)
+    bucket.acquire_sync()
+    assert sleeps[-1] == 2
+
+def test_bucket_pause_blocks_and_defers(clock, sleeps):
+    bucket = TokenBucket(rate=10, burst=10, max_wait=5)
+    bucket.pause(3)
+    bucket.acquire_sync()
+    assert sleeps == [3]
+
+    bucket.pause(30)
+    with pytest.raises(RateLimited) as error:
+        bucket.acquire_sync()
+    assert error.value.retry_after == 30
+    assert bucket.stats()["upstream_limited"] == 2 and bucket.deferred == 1
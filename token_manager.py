@@ -0,0 +1,160 @@
+import os
+import asyncio
+import datetime
+from dataclasses import dataclass
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import crud
+import crud_async
+import metrics
+import spotify
+from asyncutil import SingleFlight
+from ratelimit import RateLimited
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Tokens are refreshed by the refresh pass once they are this close to expiring.
+TOKEN_REFRESH_MARGIN = datetime.timedelta(seconds=int(os.getenv("TOKEN_REFRESH_MARGIN", "600")))
+TOKEN_REFRESH_CONCURRENCY = int(os.getenv("TOKEN_REFRESH_CONCURRENCY", "10"))
+
+def is_revoked(error: Exception):
+    """
+    True when the token endpoint rejected the refresh token itself
+    (400 `invalid_grant`: access revoked or the account gone). Throttling,
+    5xx and network errors are not: the grant is still good, so the
+    refresh is retried later.
+    """
+    response = getattr(error, "response", None)
+    if response is None or response.status_code != 400:
+        return False
+    try:
+        return response.json().get("error") == "invalid_grant"
+    except ValueError:
+        return False
+
+@dataclass
+class CachedToken:
+    access_token: str
+    refresh_token: str
+    expires_at: datetime.datetime
+
+class TokenManager:
+    """
+    Keeps every known access token in memory and refreshes them ahead of expiry.
+
+    The poll path reads tokens from here and only falls back to the `tokens`
+    table for users it has not seen yet, or whose cached token is about to
+    expire, since another process may have refreshed it. Refreshes are single-flight: all
+    concurrent callers for the same user share one request to the token
+    endpoint.
+    """
+
+    def __init__(self, refresh_margin: datetime.timedelta = TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._tokens: dict[int, CachedToken] = {}
+        self._refreshes = SingleFlight()
+
+    # --- Cache ---
+
+    def get(self, user_id: int):
+        return self._tokens.get(user_id)
+
+    def put(self, user_id: int, access_token: str, refresh_token: str, expires_at: datetime.datetime):
+        self._tokens[user_id] = CachedToken(access_token, refresh_token, expires_at)
+
+    def forget(self, user_id: int):
+        self._tokens.pop(user_id, None)
+
+    def load(self, db: Session, user_ids: list[int]):
+        """
+        Loads, with a single query, the tokens of users missing from the
+        cache or whose cached token expires within the refresh margin. The
+        refresh pass, another worker or a new login may have stored a newer
+        token; refreshing the cached one would use a refresh token that
+        Spotify may have rotated already.
+        """
+        deadline = datetime.datetime.utcnow() + self.refresh_margin
+        stale = [
+            user_id for user_id in user_ids
+            if (cached := self._tokens.get(user_id)) is None or cached.expires_at < deadline
+        ]
+        for token in crud.get_tokens_by_user_ids(db, stale):
+            cached = self._tokens.get(token.user_id)
+            if cached is None or token.expires_at >= cached.expires_at:
+                self.put(token.user_id, token.access_token, token.refresh_token, token.expires_at)
+
+    # --- Refresh ---
+
+    async def refresh(self, user_id: int, refresh_token: str):
+        """
+        Refreshes the user's access token and returns Spotify's token data.
+        If a refresh for this user is already running, waits for it instead.
+        """
+        return await self._refreshes.do(user_id, lambda: self._refresh(user_id, refresh_token))
+
+    async def _refresh(self, user_id: int, refresh_token: str):
+        try:
+            token_data = await spotify.refresh_access_token_async(refresh_token)
+        except Exception as e:
+            metrics.TOKEN_REFRESHES.inc(result="rate_limited" if isinstance(e, RateLimited) else "failure")
+            metrics.record_error("token_refresh", e)
+            raise
+        token_data.setdefault("refresh_token", refresh_token)
+        self.put(user_id, token_data["access_token"], token_data["refresh_token"], token_data["expires_at"])
+        metrics.TOKEN_REFRESHES.inc(result="success")
+        return token_data
+
+    async def refresh_expiring(
+        self,
+        db: AsyncSession,
+        limit: int = 500,
+        concurrency: int = TOKEN_REFRESH_CONCURRENCY,
+        shards: list[int] | None = None,
+        shard_count: int = 1,
+    ):
+        """
+        Refreshes up to `limit` tokens of sharing users that expire within the
+        refresh margin, concurrently, and writes them back in one transaction.
+        `shards` limits it to those users, as in `crud.get_expiring_tokens`.
+        Users whose grant was revoked stop sharing, as in the poll loop; any
+        other failure (rate limits, 5xx, timeouts) is left for the next pass,
+        since the current token is still valid for a while.
+        """
+        deadline = datetime.datetime.utcnow() + self.refresh_margin
+        expiring = await crud_async.get_expiring_tokens(db, before=deadline, limit=limit, shards=shards, shard_count=shard_count)
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(token):
+            async with semaphore:
+                try:
+                    return await self.refresh(token.user_id, token.refresh_token)
+                except Exception as e:
+                    return e
+
+        results = await asyncio.gather(*(run(token) for token in expiring))
+
+        token_rows, revoked_user_ids, deferred = [], [], 0
+        for token, token_data in zip(expiring, results):
+            if isinstance(token_data, Exception):
+                if is_revoked(token_data):
+                    revoked_user_ids.append(token.user_id)
+                    self.forget(token.user_id)
+                else:
+                    deferred += 1
+                continue
+            token_rows.append({
+                "user_id": token.user_id,
+                "access_token": token_data["access_token"],
+                "refresh_token": token_data["refresh_token"],
+                "expires_at": token_data["expires_at"],
+            })
+
+        await crud_async.bulk_stop_sharing(db, revoked_user_ids)
+        await crud_async.bulk_upsert_tokens(db, token_rows)
+        with metrics.DB_OPERATION_SECONDS.time(operation="commit_token_refresh"):
+            await db.commit()
+        return {"refreshed": len(token_rows), "revoked": len(revoked_user_ids), "deferred": deferred}
+
+# Process-wide token manager shared by the poller and the refresh pass.
+manager = TokenManager()
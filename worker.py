@@ -0,0 +1,214 @@
+"""
+Long-running poller that replaces the /tasks/update-playing cron chain.
+
+Users are split into POLL_SHARDS hash shards. Every worker process
+heartbeats, takes leases on an equal share of the shards and polls only the
+users in the shards it holds. When a worker joins, the others give up their
+surplus shards at their next heartbeat. When a worker dies, its leases
+expire and the remaining workers claim them. Start as many processes as
+there are cores, on as many nodes as needed, all using the same DATABASE_URL:
+
+    python worker.py --processes 4
+
+Workers also do the jobs of /tasks/refresh-tokens, /tasks/sweep-shares and
+/tasks/prune-history, so don't schedule any of these while they are running.
+Lease expiry is compared against each node's clock, so keep nodes NTP-synced.
+"""
+import os
+import math
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import datetime
+import multiprocessing
+import crud
+import crud_async
+import housekeeping
+import poller
+import token_manager
+from scheduler import scheduler
+from database import AsyncSessionLocal, create_db_and_tables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POLL_SHARDS = int(os.getenv("POLL_SHARDS", "64"))
+# A lease lasts POLL_LEASE_TTL seconds and is renewed every
+# POLL_HEARTBEAT_INTERVAL. A worker stops polling a shard once less than
+# POLL_LEASE_MARGIN seconds of its lease are left without a renewal, which
+# must be longer than one batch takes, so two owners never overlap.
+POLL_LEASE_TTL = float(os.getenv("POLL_LEASE_TTL", "30"))
+POLL_HEARTBEAT_INTERVAL = float(os.getenv("POLL_HEARTBEAT_INTERVAL", "10"))
+POLL_LEASE_MARGIN = float(os.getenv("POLL_LEASE_MARGIN", "15"))
+POLL_BATCH_SIZE = int(os.getenv("POLL_BATCH_SIZE", "100"))
+# Bounds on the sleep between sweeps over the owned shards.
+POLL_IDLE_MIN = float(os.getenv("POLL_IDLE_MIN", "1"))
+POLL_IDLE_MAX = float(os.getenv("POLL_IDLE_MAX", "5"))
+# Seconds between refresh passes over the owned shards' expiring tokens
+# (what /tasks/refresh-tokens does for everyone), so polls don't have to refresh inline.
+TOKEN_REFRESH_INTERVAL = float(os.getenv("TOKEN_REFRESH_INTERVAL", "60"))
+# Seconds between /tasks/sweep-shares and /tasks/prune-history runs, done by
+# whichever process holds shard 0 since they cover every user.
+SHARE_SWEEP_INTERVAL = float(os.getenv("SHARE_SWEEP_INTERVAL", "300"))
+HISTORY_PRUNE_INTERVAL = float(os.getenv("HISTORY_PRUNE_INTERVAL", "3600"))
+
+class ShardWorker:
+    """One polling process: owns a set of shard leases and polls their users."""
+
+    def __init__(self, worker_id: str, shard_count: int = POLL_SHARDS):
+        self.worker_id = worker_id
+        self.shard_count = shard_count
+        self.shards: list[int] = []
+        self._lease_expires = 0.0  # monotonic time the held leases run out unless renewed
+        self._lease_deadline = 0.0  # renew before this, so a batch can finish inside the lease
+        self._next_heartbeat = 0.0
+        self._next_token_refresh = 0.0
+        self._next_share_sweep = 0.0
+        self._next_history_prune = 0.0
+        self._stopping = False
+
+    def stop(self):
+        self._stopping = True
+
+    def rebalance(self, db):
+        """
+        Heartbeats, renews the held leases and claims or releases shards to
+        reach a fair share. Takes a sync session; run it with `AsyncSession.run_sync`.
+        """
+        started = time.monotonic()
+        now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds=POLL_LEASE_TTL)
+        crud.heartbeat_worker(db, self.worker_id, now)
+        live_workers = max(1, crud.count_live_workers(db, now - datetime.timedelta(seconds=POLL_LEASE_TTL)))
+        target = math.ceil(self.shard_count / live_workers)
+
+        shards = crud.renew_shards(db, self.worker_id, now, expires_at)
+        if len(shards) > target:
+            surplus = sorted(shards)[target:]
+            crud.release_shards(db, self.worker_id, surplus)
+            shards = sorted(shards)[:target]
+        elif len(shards) < target:
+            free = [
+                lease.shard for lease in crud.get_shard_leases(db, self.shard_count)
+                if lease.owner is None or lease.expires_at is None or lease.expires_at < now
+            ]
+            # Random order, so workers starting together don't all race for the same shards.
+            random.shuffle(free)
+            for shard in free:
+                if len(shards) >= target:
+                    break
+                if crud.try_claim_shard(db, shard, self.worker_id, now, expires_at):
+                    shards.append(shard)
+
+        self.shards = sorted(shards)
+        self._lease_expires = started + POLL_LEASE_TTL
+        self._lease_deadline = self._lease_expires - POLL_LEASE_MARGIN
+        self._next_heartbeat = started + POLL_HEARTBEAT_INTERVAL
+
+    def holds_leases(self):
+        return time.monotonic() < self._lease_expires
+
+    def _needs_rebalance(self):
+        now = time.monotonic()
+        return now >= self._next_heartbeat or now >= self._lease_deadline
+
+    async def sweep(self, db):
+        """Polls every due user of the owned shards once."""
+        after_id, polled = 0, 0
+        while not self._stopping:
+            if self._needs_rebalance():
+                await db.run_sync(self.rebalance)
+            if not self.shards:
+                break
+            batch = await crud_async.get_poll_batch(
+                db, after_id=after_id, limit=POLL_BATCH_SIZE, shards=self.shards, shard_count=self.shard_count,
+            )
+            if not batch:
+                break
+            outcome = await poller.run_batch(db, batch, still_owner=self.holds_leases)
+            polled += outcome.polled
+            if outcome.circuit_open:
+                break
+            after_id = batch[-1].share_id
+            if len(batch) < POLL_BATCH_SIZE:
+                break
+        return polled
+
+    async def refresh_tokens(self, db):
+        """Refreshes the expiring tokens of the owned shards' users, at most every TOKEN_REFRESH_INTERVAL seconds."""
+        if not self.shards or time.monotonic() < self._next_token_refresh:
+            return
+        self._next_token_refresh = time.monotonic() + TOKEN_REFRESH_INTERVAL
+        await token_manager.manager.refresh_expiring(db, shards=self.shards, shard_count=self.shard_count)
+
+    async def housekeep(self, db):
+        """Sweeps expired shares and prunes old plays when they are due, if this process holds shard 0."""
+        if 0 not in self.shards:
+            return
+        now = time.monotonic()
+        if now >= self._next_share_sweep:
+            self._next_share_sweep = now + SHARE_SWEEP_INTERVAL
+            await db.run_sync(housekeeping.sweep_shares)
+        if now >= self._next_history_prune:
+            self._next_history_prune = now + HISTORY_PRUNE_INTERVAL
+            await db.run_sync(housekeeping.prune_history)
+
+    async def run(self):
+        async with AsyncSessionLocal() as db:
+            try:
+                await crud_async.ensure_shards(db, self.shard_count)
+                while not self._stopping:
+                    try:
+                        await self.sweep(db)
+                    except Exception as e:
+                        await db.rollback()
+                        print(f"[{self.worker_id}] sweep failed: {e}")
+                    try:
+                        await self.refresh_tokens(db)
+                        await self.housekeep(db)
+                    except Exception as e:
+                        await db.rollback()
+                        print(f"[{self.worker_id}] maintenance failed: {e}")
+                    # Sleep until the next user is due, within bounds, then sweep again.
+                    next_due = scheduler.next_due_at()
+                    wait = POLL_IDLE_MAX if next_due is None else next_due - time.monotonic()
+                    await asyncio.sleep(min(max(wait, POLL_IDLE_MIN), POLL_IDLE_MAX))
+            finally:
+                await crud_async.release_shards(db, self.worker_id)
+
+def run_process(index: int):
+    worker = ShardWorker(f"{socket.gethostname()}:{os.getpid()}")
+    signal.signal(signal.SIGTERM, lambda *args: worker.stop())
+    signal.signal(signal.SIGINT, lambda *args: worker.stop())
+    print(f"[{worker.worker_id}] polling started")
+    asyncio.run(worker.run())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    create_db_and_tables()
+    if args.processes == 1:
+        run_process(0)
+        return
+
+    # Spawned, not forked, so no process inherits another's DB or HTTP connections.
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_process, args=(index,)) for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+if __name__ == "__main__":
+    main()